@@ -0,0 +1,87 @@
+import asyncio
+import time
+
+# A bucket holds at most this many seconds worth of tokens (burst size)
+BURST_SECONDS = 0.5
+
+
+class TokenBucket:
+    """
+    Token bucket for one direction of traffic. rate = bytes/sec, 0 = unlimited.
+    Callers take tokens in whole messages (one 16KB block at a time), never
+    per byte. Waiters are served first-come first-served, so peers share
+    the rate fairly instead of the fastest socket taking everything.
+    """
+
+    def __init__(self, rate=0):
+        self.rate = rate
+        self.tokens = 0.0
+        self._last_refill = time.monotonic()
+        self._lock = None
+        self._lock_loop = None
+
+    def set_rate(self, rate):
+        self._refill()
+        self.rate = rate
+
+    def _refill(self):
+        now = time.monotonic()
+        if self.rate > 0:
+            capacity = self.rate * BURST_SECONDS
+            self.tokens = min(capacity, self.tokens + (now - self._last_refill) * self.rate)
+        self._last_refill = now
+
+    async def consume(self, amount):
+        if self.rate <= 0:
+            return
+        # The global bucket can outlive an event loop (GUI runs one per download)
+        loop = asyncio.get_running_loop()
+        if self._lock_loop is not loop:
+            self._lock = asyncio.Lock()
+            self._lock_loop = loop
+
+        async with self._lock:  # FIFO: peers are served in turn
+            self._refill()
+            if self.tokens < amount:
+                await asyncio.sleep((amount - self.tokens) / self.rate)
+                self._refill()
+            # May go below zero when a grant is bigger than the bucket (debt)
+            self.tokens -= amount
+
+
+class BandwidthLimiter:
+    """
+    Upload and download limits for one scope (a torrent, or the whole process).
+    A torrent's limiter is chained to the global one, so a grant has to pass
+    both. Limits can be changed at any time with set_limits().
+    """
+
+    def __init__(self, download_rate=0, upload_rate=0, parent=None):
+        self.download_bucket = TokenBucket(download_rate)
+        self.upload_bucket = TokenBucket(upload_rate)
+        self.parent = parent
+
+    def set_limits(self, download_rate=None, upload_rate=None):
+        if download_rate is not None:
+            self.download_bucket.set_rate(download_rate)
+        if upload_rate is not None:
+            self.upload_bucket.set_rate(upload_rate)
+
+    @property
+    def download_limited(self):
+        """False when no download limit applies (here or in a parent): no need to ask."""
+        return self.download_bucket.rate > 0 or bool(self.parent and self.parent.download_limited)
+
+    async def download(self, amount):
+        await self.download_bucket.consume(amount)
+        if self.parent:
+            await self.parent.download(amount)
+
+    async def upload(self, amount):
+        await self.upload_bucket.consume(amount)
+        if self.parent:
+            await self.parent.upload(amount)
+
+
+# Process-wide limits, shared by every torrent
+global_limiter = BandwidthLimiter()
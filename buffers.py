@@ -0,0 +1,79 @@
+import asyncio
+import threading
+
+MEMORY_BUDGET = 256 * 1024 * 1024  # Piece data held in memory, all torrents together
+
+
+class BufferPool:
+    """
+    Piece buffers under one memory budget.
+    A buffer is taken when a piece is started and given back once the
+    piece is on disk (or failed its hash check), so 'used' covers pieces
+    in flight, pieces waiting for the hasher and pieces waiting for the
+    disk writer. Given back buffers are kept for the next piece of the
+    same size instead of allocating a new one. Thread-safe: the disk
+    writer threads give buffers back.
+
+    Torrents that were turned away by has_room() are called back (on
+    their event loop) as soon as memory is given back.
+    """
+
+    def __init__(self, budget=MEMORY_BUDGET):
+        self.budget = budget
+        self.used = 0  # Bytes handed out
+        self.free_bytes = 0  # Bytes kept for reuse
+        self._free = {}  # size -> [bytearray]
+        self._lock = threading.Lock()
+        self._listeners = {}  # callback -> event loop
+        self._starved = False
+
+        # Stats
+        self.allocated = 0
+        self.reused = 0
+
+    def has_room(self, size):
+        """False when a new piece of 'size' bytes would go over the budget."""
+        # Always room for one piece, even if it is bigger than the whole budget
+        if self.used == 0 or self.used + size <= self.budget:
+            return True
+        self._starved = True
+        return False
+
+    def subscribe(self, callback):
+        """Calls callback() on the current event loop whenever a starved pool frees memory."""
+        self._listeners[callback] = asyncio.get_running_loop()
+
+    def unsubscribe(self, callback):
+        self._listeners.pop(callback, None)
+
+    def acquire(self, size):
+        """A buffer of 'size' bytes. The contents are left over from its last use."""
+        with self._lock:
+            self.used += size
+            free = self._free.get(size)
+            if free:
+                self.free_bytes -= size
+                self.reused += 1
+                return free.pop()
+            # Kept buffers count towards the budget too: drop them to make room
+            if self.used + self.free_bytes > self.budget:
+                self._free.clear()
+                self.free_bytes = 0
+            self.allocated += 1
+        return bytearray(size)
+
+    def release(self, buffer):
+        size = len(buffer)
+        with self._lock:
+            self.used -= size
+            if self.used + self.free_bytes + size <= self.budget:
+                self._free.setdefault(size, []).append(buffer)
+                self.free_bytes += size
+            wake, self._starved = self._starved, False
+            listeners = list(self._listeners.items()) if wake else ()
+
+        for callback, loop in listeners:
+            try:
+                loop.call_soon_threadsafe(callback)
+            except RuntimeError:
+                pass  # That loop is gone
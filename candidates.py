@@ -0,0 +1,137 @@
+import heapq
+import random
+import time
+
+# Backoff for peers that fail (refused, timed out, useless), doubled per failure
+RETRY_BASE = 30  # seconds
+MAX_BACKOFF = 3600
+MAX_FAILURES = 6  # then the candidate is forgotten
+RECONNECT_DELAY = 60  # after a normal disconnect
+
+
+class Candidate:
+    """Everything we know about one peer address, connected or not."""
+    __slots__ = (
+        "ip", "port", "source", "attempts", "failures", "last_attempt", "last_failure",
+        "next_attempt", "connected", "rate", "bytes_downloaded", "_version",
+    )
+
+    def __init__(self, ip, port, source):
+        self.ip = ip
+        self.port = port
+        self.source = source  # 'tracker', ...
+        self.attempts = 0
+        self.failures = 0  # Consecutive
+        self.last_attempt = 0
+        self.last_failure = 0
+        self.next_attempt = 0
+        self.connected = False
+        self.rate = 0.0  # Observed download rate (bytes/sec, smoothed over connections)
+        self.bytes_downloaded = 0
+        self._version = 0  # Invalidates stale heap entries
+
+    @property
+    def score(self):
+        # Known-good peers first, untried peers next, flaky peers last
+        return self.rate - self.failures * 1024
+
+
+class CandidatePool:
+    """
+    Indexed pool of peer addresses with per-peer state.
+    Candidates that can be dialed sit in a max-heap by score. Candidates
+    that are backing off sit in a min-heap by retry time and move over when
+    it passes. A tick only touches the candidates it dials or wakes up,
+    never the whole pool.
+    """
+
+    def __init__(self):
+        self.candidates = {}  # (ip, port) -> Candidate
+        self._ready = []  # (-score, tiebreak, version, candidate)
+        self._waiting = []  # (next_attempt, tiebreak, version, candidate)
+        self.connected_count = 0
+
+    def __len__(self):
+        return len(self.candidates)
+
+    @property
+    def ready_count(self):
+        """Upper bound (the heap may still hold a few stale entries)."""
+        return len(self._ready)
+
+    def add(self, peers, source="tracker"):
+        added = 0
+        for ip, port in peers:
+            key = (ip, port)
+            if key in self.candidates:
+                continue
+            candidate = Candidate(ip, port, source)
+            self.candidates[key] = candidate
+            self._push_ready(candidate)
+            added += 1
+        return added
+
+    def _push_ready(self, candidate):
+        candidate._version += 1
+        heapq.heappush(self._ready, (-candidate.score, random.random(), candidate._version, candidate))
+
+    def _push_waiting(self, candidate):
+        candidate._version += 1
+        heapq.heappush(self._waiting, (candidate.next_attempt, random.random(), candidate._version, candidate))
+
+    def next_to_dial(self, count, exclude_ips=()):
+        """Pops up to 'count' of the best candidates whose backoff has expired."""
+        now = time.time()
+        while self._waiting and self._waiting[0][0] <= now:
+            _, _, version, candidate = heapq.heappop(self._waiting)
+            if version == candidate._version:
+                self._push_ready(candidate)
+
+        chosen = []
+        skipped = []
+        while self._ready and len(chosen) < count:
+            _, _, version, candidate = heapq.heappop(self._ready)
+            if version != candidate._version or candidate.connected:
+                continue  # Stale entry
+            if candidate.ip in exclude_ips:
+                skipped.append(candidate)
+                continue
+            candidate.attempts += 1
+            candidate.last_attempt = now
+            candidate.connected = True
+            self.connected_count += 1
+            chosen.append(candidate)
+
+        for candidate in skipped:
+            self._push_ready(candidate)
+        return chosen
+
+    def disconnected(self, candidate, downloaded, duration, failed):
+        """
+        Records how a connection went. 'failed' means we got nothing useful
+        (refused, timed out, no handshake, or no data at all).
+        """
+        now = time.time()
+        if candidate.connected:
+            candidate.connected = False
+            self.connected_count -= 1
+        candidate.bytes_downloaded += downloaded
+
+        if duration > 0:
+            sample = downloaded / duration
+            candidate.rate = sample if candidate.rate == 0 else 0.5 * candidate.rate + 0.5 * sample
+
+        if failed:
+            candidate.failures += 1
+            candidate.last_failure = now
+            if candidate.failures > MAX_FAILURES:
+                self.candidates.pop((candidate.ip, candidate.port), None)
+                candidate._version += 1
+                return
+            delay = min(MAX_BACKOFF, RETRY_BASE * 2 ** (candidate.failures - 1))
+        else:
+            candidate.failures = 0
+            delay = RECONNECT_DELAY
+
+        candidate.next_attempt = now + delay
+        self._push_waiting(candidate)
@@ -0,0 +1,80 @@
+import asyncio
+import random
+import time
+
+CHOKE_INTERVAL = 10  # seconds between rechokes
+OPTIMISTIC_INTERVAL = 30  # seconds an optimistic unchoke lasts
+SNUB_TIMEOUT = 60  # no block for this long while we want data = snubbed
+UPLOAD_SLOTS = 4  # regular unchoke slots (plus one optimistic)
+
+
+class Choker:
+    """
+    Tit-for-tat choking.
+    Every 10 seconds the interested peers are ranked by how fast they sent
+    us data during the last round (or how fast we sent data to them once we
+    are seeding) and the best 'upload_slots' get unchoked. One extra
+    optimistic slot goes to a random peer every 30 seconds, so new peers get
+    a chance to prove themselves. Peers that snub us (unchoked, interested,
+    but no data for 60 seconds) only ever get the optimistic slot.
+    """
+
+    def __init__(self, client, upload_slots=UPLOAD_SLOTS):
+        self.client = client
+        self.upload_slots = upload_slots
+        self.optimistic = None
+        self._optimistic_since = 0
+        self._last_totals = {}  # peer -> byte counter at the previous round
+        self._last_round = time.time()
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(CHOKE_INTERVAL)
+            self.rechoke()
+
+    def has_free_slot(self):
+        """A peer became interested: unchoke it now if a regular slot is free."""
+        unchoked = sum(1 for p in self.client.peers if not p.am_choking and p is not self.optimistic)
+        return unchoked < self.upload_slots
+
+    def rechoke(self):
+        now = time.time()
+        elapsed = max(now - self._last_round, 1e-3)
+        self._last_round = now
+        seeding = self.client.piece_manager.complete
+        peers = [p for p in self.client.peers if p.transport and not p.closed]
+
+        # 1. Rate of each peer over the last round
+        rates = {}
+        totals = {}
+        for peer in peers:
+            total = peer.uploaded if seeding else peer.downloaded
+            totals[peer] = total
+            rates[peer] = (total - self._last_totals.get(peer, total)) / elapsed
+        self._last_totals = totals
+
+        # 2. Anti-snubbing
+        for peer in peers:
+            peer.snubbed = (
+                not seeding and peer.am_interested and not peer.peer_choking
+                and now - peer.last_block_time > SNUB_TIMEOUT
+            )
+
+        # 3. Regular slots: the best reciprocators
+        candidates = [p for p in peers if p.peer_interested and not p.snubbed]
+        candidates.sort(key=lambda p: rates[p], reverse=True)
+        unchoke = set(candidates[:self.upload_slots])
+
+        # 4. Optimistic slot, rotated every 30 seconds
+        # (a new pick is also needed if the last one earned a regular slot)
+        if (self.optimistic not in peers or not self.optimistic.peer_interested
+                or self.optimistic in unchoke
+                or now - self._optimistic_since >= OPTIMISTIC_INTERVAL):
+            others = [p for p in peers if p.peer_interested and p not in unchoke]
+            self.optimistic = random.choice(others) if others else None
+            self._optimistic_since = now
+        if self.optimistic is not None:
+            unchoke.add(self.optimistic)
+
+        for peer in peers:
+            peer.set_choking(peer not in unchoke)
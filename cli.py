@@ -0,0 +1,90 @@
+import asyncio
+import logging
+import signal
+import time
+from session import Session
+from ui import ui
+
+PROGRESS_INTERVAL = 2  # seconds between progress lines
+
+
+def _format_eta(seconds):
+    if seconds is None:
+        return "--"
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return f"{seconds // 3600}h{seconds % 3600 // 60:02d}m"
+    return f"{seconds // 60}m{seconds % 60:02d}s"
+
+
+async def _print_progress(session):
+    while True:
+        await asyncio.sleep(PROGRESS_INTERVAL)
+        for t in session.stats()["torrents"]:
+            ui.print_log(
+                f"{t['name'][:30]:30} {t['state']:11} {t['progress'] * 100:5.1f}% | "
+                f"down {t['download_rate'] / 1024:7.0f} KB/s | up {t['upload_rate'] / 1024:6.0f} KB/s | "
+                f"{t['peers']} peers | ETA {_format_eta(t['eta'])}"
+            )
+
+
+def _install_signal_handlers(loop, on_signal):
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, on_signal)
+        except (NotImplementedError, RuntimeError):
+            # Windows: no loop signal handlers, fall back to the plain signal module
+            signal.signal(sig, lambda *_: loop.call_soon_threadsafe(on_signal))
+
+
+async def _run(args, started):
+    session = Session(
+        args.output, max_active=args.max_active,
+        download_limit=args.download_limit * 1024, upload_limit=args.upload_limit * 1024,
+        listen_port=args.port, memory_budget=args.memory * 1024 * 1024,
+    )
+    for path in args.torrents:
+        client = session.add(path, seed=args.seed)
+        ui.print_log(f"Loaded {client.torrent.name} ({client.torrent.total_length / (1024 * 1024):.2f} MB)")
+    # Process start -> engine ready. Mostly import cost, so watch it when adding dependencies.
+    ui.print_log(f"Startup took {(time.perf_counter() - started) * 1000:.0f} ms")
+
+    engine = asyncio.create_task(session.run())
+    done = asyncio.create_task(session.wait_finished())
+    progress = None if args.quiet else asyncio.create_task(_print_progress(session))
+
+    stopping = False
+    closing = None
+
+    def on_signal():
+        # First signal: stop cleanly (resume data saved, 'stopped' sent to trackers).
+        # Second signal: stop waiting for that too.
+        nonlocal stopping
+        ui.print_log("Force quit" if stopping else "Shutting down...", "WARNING")
+        if stopping and closing:
+            closing.cancel()
+        stopping = True
+        done.cancel()
+
+    _install_signal_handlers(asyncio.get_running_loop(), on_signal)
+
+    try:
+        await done
+    except asyncio.CancelledError:
+        pass
+    finally:
+        if progress:
+            progress.cancel()
+        closing = asyncio.create_task(session.close())
+        try:
+            await closing
+        except asyncio.CancelledError:
+            pass
+        engine.cancel()
+
+
+def run(args, started):
+    """Headless mode: torrents run in a Session, progress on the terminal, no GUI imports."""
+    if not args.verbose:
+        logging.getLogger().setLevel(logging.INFO)
+    asyncio.run(_run(args, started))
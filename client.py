@@ -1,79 +1,393 @@
 import asyncio
-import random
+import time
+from types import MappingProxyType
 from torrent import Torrent
 from tracker import TrackerManager
 from piece_manager import PieceManager
 from peer import PeerConnection
 from file_handler import FileHandler
-from utils import generate_peer_id
+from hasher import HashPool
+from resume import FastResume
+from choker import Choker
+from bandwidth import BandwidthLimiter, global_limiter
+from buffers import BufferPool, MEMORY_BUDGET
+from candidates import CandidatePool
+from dialer import Dialer, MAX_HALF_OPEN
+from listener import PeerListener, LISTEN_PORT
+from stats import TrafficCounters, session_traffic
+from utils import generate_peer_id, logger
+
+RESUME_SAVE_INTERVAL = 60  # seconds
+HASH_DRAIN_TIMEOUT = 10  # seconds a stop waits for pieces still being hashed
+STATS_INTERVAL = 0.5  # seconds between snapshots on 'stats_queue'
+
+# NITRO MODE: Higher Peer Limit (130)
+# Note: Too high might crash your home router. 130 is the sweet spot.
+# (A Session lowers each torrent's 'max_peers' to share its global cap.)
+MAX_ACTIVE_PEERS = 130
+
+# Swarm churn: every CHURN_INTERVAL seconds, when better candidates are waiting,
+# drop idle peers and the slowest few to make room for them
+CHURN_INTERVAL = 30
+CHURN_GRACE = 60  # seconds a new connection gets to prove itself
+CHURN_SLOWEST = 2
 
 
 class TorrentClient:
-    def __init__(self, torrent_file, save_path):
+    def __init__(self, torrent_file, save_path, hash_workers=None, hash_processes=False, seed=False,
+                 upload_slots=4, download_limit=0, upload_limit=0, max_half_open=MAX_HALF_OPEN,
+                 stats_queue=None, hash_pool=None, udp_client=None, dialer=None, disk_pool=None,
+                 listen_port=LISTEN_PORT, listener=None, memory_budget=MEMORY_BUDGET, buffer_pool=None):
+        # hash_pool, udp_client, dialer, disk_pool, listener and buffer_pool can be
+        # shared between torrents (see session.py). Anything not passed in is private.
         self.peer_id = generate_peer_id()
         self.torrent = Torrent(torrent_file)
         self.torrent.peer_id = self.peer_id
 
-        self.tracker_manager = TrackerManager(self.torrent)
-        self.piece_manager = PieceManager(self.torrent)
-        self.file_handler = FileHandler(self.torrent, save_path)
+        # Piece data in memory (in flight, hashing, waiting for the disk) stays under the budget
+        self.buffer_pool = buffer_pool or BufferPool(memory_budget)
+        self.piece_manager = PieceManager(self.torrent, buffer_pool=self.buffer_pool)
+        self.tracker_manager = TrackerManager(self.torrent, stats=self.transfer_stats, udp_client=udp_client)
+        self.file_handler = FileHandler(
+            self.torrent, save_path, disk_pool=disk_pool, buffer_pool=self.buffer_pool
+        )
+        self._own_hash_pool = hash_pool is None
+        self.hash_pool = hash_pool or HashPool(workers=hash_workers, use_processes=hash_processes)
+        self.fast_resume = FastResume(
+            self.torrent, self.piece_manager, self.file_handler, self.hash_pool, save_path
+        )
+        self.hash_jobs = set()  # This torrent's pieces in the hash pool (results still to come)
+
+        self.choker = Choker(self, upload_slots=upload_slots)
+        # Bytes/sec, 0 = unlimited. Also capped by bandwidth.global_limiter.
+        self.bandwidth = BandwidthLimiter(download_limit, upload_limit, parent=global_limiter)
 
         self.peers = []
-        self.all_candidates = []
+        self.candidates = CandidatePool()
+        self.dialer = dialer or Dialer(max_half_open=max_half_open)
+        self.max_peers = MAX_ACTIVE_PEERS
+        # Incoming connections. A private listener is started by start().
+        self._own_listener = listener is None
+        self.listener = listener or PeerListener(port=listen_port)
+        self.accepting = False  # The listener only hands us peers while this is set
+        self._candidates_found = asyncio.Event()
         self.is_paused = False
+        self.stopped = True  # Not running: late hash results are thrown away
+        self.seed = seed  # Keep uploading after the download completes
+        self.loop = None  # Set by start()
+
+        # Other threads (the GUI) never touch live state: they get read-only
+        # stats() snapshots on this queue (anything with put(), e.g. queue.SimpleQueue)
+        self.stats_queue = stats_queue
+
+        # Every byte on the wire, per torrent (each peer's counters chain up here)
+        self.traffic = TrafficCounters(parent=session_traffic)
+        # Reported to trackers. 'downloaded' counts from this session's start.
+        self._bytes_at_start = 0
+        self._restored = False  # start() can run again after a stop (Session pause/resume)
+        self._parked = None  # Unfinished pieces saved at the last stop (their blocks are on disk)
+
+    @property
+    def uploaded(self):
+        return self.traffic.payload_up.total
+
+    def transfer_stats(self):
+        """(uploaded, downloaded, left) for tracker announces."""
+        completed = self.piece_manager.bytes_completed
+        return self.uploaded, completed - self._bytes_at_start, self.torrent.total_length - completed
+
+    def stats(self):
+        """
+        Snapshot of this torrent's numbers, as plain values.
+        Only walks the connected peers, so it is fine to call every second.
+        """
+        pm = self.piece_manager
+        left = self.torrent.total_length - pm.bytes_completed
+        stats = self.traffic.snapshot()
+        rate = stats["download_rate"]
+
+        if self.file_handler.error is not None:
+            state = "error"
+        elif pm.complete:
+            state = "seeding" if self.seed else "complete"
+        else:
+            state = "paused" if self.is_paused else "downloading"
+
+        connected = [p for p in self.peers if p.handshaken and not p.closed]
+        stats.update({
+            "info_hash": self.torrent.info_hash.hex(),
+            "name": self.torrent.name,
+            "state": state,
+            "size": self.torrent.total_length,
+            "completed": pm.bytes_completed,
+            "left": left,
+            "progress": pm.bytes_completed / self.torrent.total_length if self.torrent.total_length else 1.0,
+            "pieces_done": pm.have_count,
+            "pieces_total": pm.total_pieces,
+            "pieces_in_flight": len(pm.partial_pieces),
+            "hash_failures": pm.hash_failures,
+            "eta": left / rate if left and rate > 0 and not self.is_paused else None,  # seconds
+            "peers": len(connected),
+            "peers_connecting": len(self.peers) - len(connected),
+            "peers_incoming": sum(1 for p in connected if p.incoming),
+            "candidates": len(self.candidates),
+            "requests_outstanding": sum(len(p.outstanding) for p in connected),
+            "request_timeouts": pm.request_timeouts,
+            "endgame": pm.is_endgame and not pm.complete,
+            "wasted_bytes": pm.wasted_bytes,
+            "cancels_sent": pm.cancels_sent,
+            "upload_queue": sum(len(p.upload_queue) for p in connected),
+            "hash_queue": self.hash_pool.pending,
+            "hash_queue_latency": self.hash_pool.queue_latency,
+            "disk_queue_bytes": self.file_handler.pending_bytes,
+            "disk_error": str(self.file_handler.error) if self.file_handler.error else None,
+            "memory_used": self.buffer_pool.used,
+            "memory_budget": self.buffer_pool.budget,
+            "connect_success_rate": self.dialer.success_rate,
+            "handshake_latency": self.dialer.handshake_latency,
+        })
+        return stats
 
     def toggle_pause(self):
         self.is_paused = not self.is_paused
+        if not self.is_paused:
+            for peer in self.peers:
+                peer._upload_wakeup.set()
+
+    def run_threadsafe(self, func, *args):
+        """Calls func(*args) on the client's event loop. For use from other threads."""
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(func, *args)
+
+    def set_limits(self, download_limit=None, upload_limit=None):
+        """Changes this torrent's rate limits (bytes/sec, 0 = unlimited) while running."""
+        self.bandwidth.set_limits(download_limit, upload_limit)
+
+    def broadcast_have(self, index):
+        """Tells every connected peer about a piece we just finished."""
+        for peer in self.peers:
+            peer.send_have(index)
+
+    def add_candidates(self, peers):
+        """New peers from a tracker. They are dialed on the next swarm tick."""
+        self.candidates.add(peers, source="tracker")
+        if len(self.candidates):
+            self._candidates_found.set()
 
     async def start(self):
-        print("DEBUG: Contacting Trackers...")
-        self.all_candidates = self.tracker_manager.get_peers()
+        self.loop = asyncio.get_running_loop()
+        self.stopped = False
+        if self._own_listener and self.listener.server is None:
+            try:
+                await self.listener.start()
+            except OSError as e:
+                logger.warning(f"Could not listen on port {self.listener.port}: {e}")
+        self.tracker_manager.listen_port = self.listener.port
+        self.listener.add_torrent(self)
+        # Memory freed up after the budget ran out: pick new pieces right away
+        self.buffer_pool.subscribe(self._wake_idle_peers)
 
-        if not self.all_candidates:
-            print("CRITICAL: No peers found.")
+        publisher = asyncio.create_task(self._publish_stats()) if self.stats_queue else None
+        try:
+            await self._run()
+        finally:
+            self.stopped = True
+            self.buffer_pool.unsubscribe(self._wake_idle_peers)
+            self.listener.remove_torrent(self.torrent.info_hash)
+            if self._own_listener:
+                await self.listener.close()
+            if publisher:
+                publisher.cancel()
+                self._publish_snapshot()  # Final state
+
+    async def _run(self):
+        # Pick up where we left off (or recheck what is already on disk)
+        if not self._restored:
+            await self.fast_resume.restore()
+            self._bytes_at_start = self.piece_manager.bytes_completed
+            self._restored = True
+        elif self._parked:
+            self.fast_resume.restore_partial(self._parked)
+            self._parked = None
+        if self.piece_manager.complete and not self.seed:
+            # A recheck may have found it complete: save it, or every start rehashes it all
+            await self.fast_resume.save_async()
+            print("DOWNLOAD COMPLETE!")
             return
 
-        print(f"DEBUG: Found {len(self.all_candidates)} candidates. Engaging Nitro Mode...")
-        await self._maintain_swarm()
+        print("DEBUG: Contacting Trackers...")
+        announce_task = asyncio.create_task(self.tracker_manager.run(self.add_candidates))
+        resume_task = asyncio.create_task(self._save_resume_periodically())
+        choke_task = asyncio.create_task(self.choker.run())
+        # Peers that got our address from a tracker can connect right away
+        self.accepting = True
+        try:
+            # Start as soon as the first tracker answers, not when the last one gives up
+            waiters = [
+                asyncio.create_task(self._candidates_found.wait()),
+                asyncio.create_task(self.tracker_manager.first_round_done.wait()),
+            ]
+            try:
+                await asyncio.wait(waiters, return_when=asyncio.FIRST_COMPLETED)
+            finally:
+                for waiter in waiters:
+                    waiter.cancel()
+
+            if len(self.candidates):
+                print(f"DEBUG: Found {len(self.candidates)} candidates. Engaging Nitro Mode...")
+            else:
+                # Keep going: the trackers are asked again, and peers can still connect to us
+                logger.warning("No peers found yet. Waiting for trackers and incoming peers...")
+            await self._maintain_swarm(until_complete=True)
+            if self.file_handler.error is None:
+                await asyncio.to_thread(self.file_handler.flush)
+            if self.file_handler.error is not None:
+                logger.error(f"Stopping {self.torrent.name}: disk write failed: {self.file_handler.error}")
+                return
+            print("DOWNLOAD COMPLETE!")
+            await self.tracker_manager.announce_event('completed')
+            if self.seed:
+                await self._maintain_swarm(until_complete=False)
+        finally:
+            self.accepting = False
+            announce_task.cancel()
+            resume_task.cancel()
+            choke_task.cancel()
+            for peer in self.peers:
+                peer.close()
+                self._peer_finished(peer)
+            self.peers = []
+            # Verified pieces are written when their hash comes back: wait for
+            # them, or they would change the files after the resume data is saved
+            if self.hash_jobs:
+                await asyncio.wait(self.hash_jobs, timeout=HASH_DRAIN_TIMEOUT)
+            self.stopped = True  # Anything that comes back later is dropped
+            if self._own_hash_pool:
+                self.hash_pool.close()
+            try:
+                # After a disk error the bitfield may claim pieces that never made it
+                # to disk: no save, the next start rechecks the files instead
+                if self.file_handler.error is None:
+                    self._parked = (await self.fast_resume.save_async())["partial"]
+            finally:
+                # A stopped torrent holds no part of the (shared) memory budget.
+                # The saved blocks are read back by the next start.
+                self.piece_manager.close()
+            await self.tracker_manager.announce_event('stopped')
+
+    def _publish_snapshot(self):
+        self.stats_queue.put(MappingProxyType(self.stats()))
 
-    async def _maintain_swarm(self):
-        # NITRO MODE: Higher Peer Limit (130)
-        # Note: Too high might crash your home router. 130 is the sweet spot.
-        MAX_ACTIVE_PEERS = 130
+    async def _publish_stats(self):
+        while True:
+            self._publish_snapshot()
+            await asyncio.sleep(STATS_INTERVAL)
 
-        while not self.piece_manager.complete:
+    async def _save_resume_periodically(self):
+        while True:
+            await asyncio.sleep(RESUME_SAVE_INTERVAL)
+            try:
+                await self.fast_resume.save_async()
+            except OSError as e:
+                logger.warning(f"Could not save resume data: {e}")
+
+    async def _maintain_swarm(self, until_complete=True):
+        last_churn = time.time()
+
+        while not (until_complete and self.piece_manager.complete):
+            if self.file_handler.error is not None:
+                return  # Disk failure: _run stops the torrent
             if self.is_paused:
                 await asyncio.sleep(1)
                 continue
 
-            # 1. Aggressive Pruning: Remove closed connections instantly
-            self.peers = [p for p in self.peers if not p.closed]
+            # 1. Aggressive Pruning: Remove closed connections instantly,
+            # and remember how they went (failures back off, fast peers score up)
+            live = []
+            for peer in self.peers:
+                if peer.closed:
+                    self._peer_finished(peer)
+                else:
+                    live.append(peer)
+            self.peers = live
+
+            # Wake up idle pipelines (after a pause or while the disk was backlogged)
+            self._wake_idle_peers()
 
             # 2. Refill the Swarm
             active_count = len(self.peers)
-            needed = MAX_ACTIVE_PEERS - active_count
+            needed = self.max_peers - active_count
+            slack = min(5, self.max_peers // 10)  # Don't bother dialing for fewer than this
 
-            if needed > 5 and self.all_candidates:  # Only refill if we need at least 5
-                random.shuffle(self.all_candidates)
-                current_ips = {p.ip for p in self.peers}
-                new_batch = []
+            # Over the limit (a Session shrank our share): let the slowest go
+            if needed < 0:
+                for peer in sorted(self.peers, key=lambda p: p.download_rate)[:-needed]:
+                    peer.close()
 
-                for ip, port in self.all_candidates:
-                    if ip not in current_ips:
-                        new_batch.append((ip, port))
-                        if len(new_batch) >= needed:
-                            break
+            # Running dry: ask the trackers again (as early as their min interval allows).
+            # Not while seeding: peers that want data find us through the tracker.
+            if self.candidates.ready_count < needed and not self.piece_manager.complete:
+                self.tracker_manager.need_more_peers()
 
-                for ip, port in new_batch:
+            # 3. Churn: swap idle and slow peers for fresh candidates
+            if time.time() - last_churn >= CHURN_INTERVAL:
+                last_churn = time.time()
+                if needed <= slack and self.candidates.ready_count:
+                    self._drop_worst_peers()
+
+            # Staged ramp-up: only queue about two rounds of dials at a time,
+            # the rest are picked next tick (with fresher scores)
+            dial_budget = 2 * self.dialer.max_half_open - self.dialer.half_open - self.dialer.queued
+            dial_count = min(needed, dial_budget)
+
+            if needed > slack and dial_count > 0:  # Only refill if we need more than a few
+                current_ips = {p.ip for p in self.peers}
+                # Best scored first, peers in backoff are skipped
+                for candidate in self.candidates.next_to_dial(dial_count, exclude_ips=current_ips):
                     peer = PeerConnection(
-                        ip, port, self.torrent, self.peer_id,
-                        self.piece_manager, self.file_handler
+                        candidate.ip, candidate.port, self.torrent, self.peer_id,
+                        self.piece_manager, self.file_handler, self.hash_pool
                     )
                     peer.client = self
+                    peer.candidate = candidate
                     self.peers.append(peer)
                     asyncio.create_task(peer.start())
 
             # Check faster (Every 2 seconds) to keep speed high
             await asyncio.sleep(2)
 
-        print("DOWNLOAD COMPLETE!")
\ No newline at end of file
+    def _wake_idle_peers(self):
+        for peer in self.peers:
+            if peer.transport and not peer.outstanding and not peer.closed:
+                peer._request_piece()
+
+    def _peer_finished(self, peer):
+        if peer.candidate is None:
+            return
+        # Refused, timed out, no handshake, or connected for a while without
+        # sending or taking a single byte = failure
+        duration = time.time() - peer.connected_at
+        useless = peer.downloaded == 0 and peer.uploaded == 0 and duration > CHURN_GRACE
+        failed = not peer.handshaken or useless
+        self.candidates.disconnected(peer.candidate, peer.downloaded, duration, failed)
+
+    def _drop_worst_peers(self):
+        """
+        Closes peers that are doing nothing for us (no block for a while and
+        we are not uploading to them), plus the slowest few of the rest.
+        """
+        now = time.time()
+        settled = [p for p in self.peers if p.handshaken and now - p.connected_at > CHURN_GRACE]
+        uploading = lambda p: not p.am_choking and p.peer_interested
+
+        idle = [p for p in settled if now - p.last_block_time > CHURN_GRACE and not uploading(p)]
+        if not self.piece_manager.complete and settled:
+            # Slow = well under the swarm average, not just last in line
+            average = sum(p.download_rate for p in settled) / len(settled)
+            slow = [p for p in settled if p not in idle and not uploading(p)
+                    and p.download_rate < average / 4]
+            slow.sort(key=lambda p: p.download_rate)
+            idle.extend(slow[:CHURN_SLOWEST])
+
+        for peer in idle[:self.candidates.ready_count]:
+            peer.close()
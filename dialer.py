@@ -0,0 +1,119 @@
+import asyncio
+import heapq
+import itertools
+import time
+
+MAX_HALF_OPEN = 16  # TCP connects in progress at once
+CONNECT_TIMEOUT = 5  # seconds
+DIAL_INTERVAL = 0.02  # seconds between two SYNs (max 50 dials/sec)
+
+
+class Dialer:
+    """
+    Opens outgoing peer connections without flooding the network.
+    At most 'max_half_open' connects are in progress at once and new ones
+    are spaced out by DIAL_INTERVAL, so a full swarm refill doesn't send
+    130 SYNs in the same millisecond (home routers and conntrack tables
+    drop a lot of those). Waiting dials go out best score first.
+    """
+
+    def __init__(self, max_half_open=MAX_HALF_OPEN, connect_timeout=CONNECT_TIMEOUT):
+        self.max_half_open = max_half_open
+        self.connect_timeout = connect_timeout
+        self.half_open = 0
+        self._waiters = []  # (-priority, seq, future)
+        self._seq = itertools.count()
+        self._next_dial = 0.0
+
+        # Stats
+        self.attempts = 0
+        self.connected = 0
+        self.failed = 0
+        self.timeouts = 0
+        self.connect_latency = 0.0  # seconds (smoothed)
+        self.handshakes = 0
+        self.handshake_failures = 0
+        self.handshake_latency = 0.0  # seconds (smoothed)
+
+    @property
+    def queued(self):
+        return len(self._waiters)
+
+    @property
+    def success_rate(self):
+        done = self.connected + self.failed
+        return self.connected / done if done else 0.0
+
+    async def connect(self, ip, port, protocol_factory, priority=0):
+        """Waits for a free slot, then opens the connection. Returns the protocol."""
+        slot = self._acquire(priority)
+        try:
+            await slot
+        except asyncio.CancelledError:
+            if slot.done() and not slot.cancelled():
+                self._release()  # Granted, but cancelled before we could use it
+            raise
+
+        try:
+            # Space the SYNs out even when many slots free up at once
+            now = time.monotonic()
+            delay = self._next_dial - now
+            self._next_dial = max(now, self._next_dial) + DIAL_INTERVAL
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+            self.attempts += 1
+            start = time.monotonic()
+            try:
+                _, protocol = await asyncio.wait_for(
+                    asyncio.get_running_loop().create_connection(protocol_factory, ip, port),
+                    timeout=self.connect_timeout
+                )
+            except asyncio.TimeoutError:
+                self.failed += 1
+                self.timeouts += 1
+                raise
+            except Exception:
+                self.failed += 1
+                raise
+
+            self.connected += 1
+            self.connect_latency = _ewma(self.connect_latency, time.monotonic() - start)
+            return protocol
+        finally:
+            self._release()
+
+    def record_handshake(self, latency, ok=True):
+        if ok:
+            self.handshakes += 1
+            self.handshake_latency = _ewma(self.handshake_latency, latency)
+        else:
+            self.handshake_failures += 1
+
+    def _acquire(self, priority):
+        future = asyncio.get_running_loop().create_future()
+        if self.half_open < self.max_half_open and not self._waiters:
+            self.half_open += 1
+            future.set_result(None)
+        else:
+            heapq.heappush(self._waiters, (-priority, next(self._seq), future))
+            future.add_done_callback(self._waiter_done)
+        return future
+
+    def _waiter_done(self, future):
+        # A dial cancelled while queued (peer closed, shutdown) gives its turn away
+        if future.cancelled():
+            self._waiters = [w for w in self._waiters if w[2] is not future]
+            heapq.heapify(self._waiters)
+
+    def _release(self):
+        self.half_open -= 1
+        while self._waiters and self.half_open < self.max_half_open:
+            _, _, future = heapq.heappop(self._waiters)
+            if not future.done():
+                self.half_open += 1
+                future.set_result(None)
+
+
+def _ewma(current, sample, alpha=0.2):
+    return sample if current == 0 else (1 - alpha) * current + alpha * sample
@@ -1,14 +1,195 @@
+import asyncio
 import os
+import time
+import threading
+from collections import deque, OrderedDict
 from utils import logger
 
+# Windows needs O_BINARY or it will mangle '\n' bytes
+OPEN_FLAGS = os.O_RDWR | os.O_CREAT | getattr(os, "O_BINARY", 0)
+
+# pwritev takes at most IOV_MAX buffers per call (1024 on Linux)
+IOV_MAX = 1024
+
+# fsync policies
+FSYNC_NONE = "none"  # leave it to the OS
+FSYNC_INTERVAL = "interval"  # at most every 'fsync_interval' seconds
+FSYNC_ALWAYS = "always"  # after every batch of writes
+
+# Pieces kept in memory for uploading
+READ_CACHE_BYTES = 32 * 1024 * 1024
+
+# An idle DiskPool checks this often for files that still need an fsync
+FSYNC_CHECK_INTERVAL = 1.0
+
+
+class PieceCache:
+    """
+    LRU cache of whole pieces for the upload path.
+    Peers usually ask for the same (freshly announced, rare) pieces, so one
+    disk read serves many of them. Misses are read in a worker thread, and
+    concurrent misses for the same piece share a single read.
+    """
+
+    def __init__(self, file_handler, capacity=READ_CACHE_BYTES):
+        self.file_handler = file_handler
+        self.capacity = capacity
+        self.size = 0
+        self._pieces = OrderedDict()  # index -> bytes
+        self._loading = {}  # index -> future
+
+        # Stats
+        self.hits = 0
+        self.misses = 0
+
+    def put(self, index, data):
+        if index in self._pieces:
+            self._pieces.move_to_end(index)
+            return
+        self._pieces[index] = data
+        self.size += len(data)
+        while self.size > self.capacity and self._pieces:
+            _, old = self._pieces.popitem(last=False)
+            self.size -= len(old)
+
+    async def get(self, index):
+        data = self._pieces.get(index)
+        if data is not None:
+            self._pieces.move_to_end(index)
+            self.hits += 1
+            return data
+
+        self.misses += 1
+        future = self._loading.get(index)
+        if future is None:
+            future = asyncio.ensure_future(asyncio.to_thread(self.file_handler.read, index))
+            self._loading[index] = future
+            future.add_done_callback(lambda f: self._loaded(index, f))
+        # Shielded: a peer that closes mid-read must not cancel it for the others
+        return await asyncio.shield(future)
+
+    def _loaded(self, index, future):
+        self._loading.pop(index, None)
+        if not future.cancelled() and future.exception() is None:
+            self.put(index, future.result())
+
+
+class DiskPool:
+    """
+    Writer threads, shared by any number of FileHandlers.
+    A handler with queued data is put on the ready list (once), and the
+    next free thread writes everything that handler has queued. A handler
+    is never written by two threads at once, so its writes stay in order.
+    Hundreds of torrents can share a couple of threads this way.
+    """
+
+    def __init__(self, workers=1):
+        self._cond = threading.Condition()
+        self._ready = deque()
+        self._handlers = set()
+        self._closing = False
+        self._threads = [
+            threading.Thread(target=self._worker, name=f"disk-writer-{i}", daemon=True)
+            for i in range(workers)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def register(self, handler):
+        with self._cond:
+            self._handlers.add(handler)
+
+    def unregister(self, handler):
+        with self._cond:
+            self._handlers.discard(handler)
+
+    def schedule(self, handler):
+        with self._cond:
+            if handler._scheduled:
+                return
+            handler._scheduled = True
+            self._ready.append(handler)
+            self._cond.notify()
+
+    def close(self):
+        with self._cond:
+            self._closing = True
+            self._cond.notify_all()
+        for thread in self._threads:
+            thread.join()
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                while not self._ready and not self._closing:
+                    if not self._cond.wait(timeout=FSYNC_CHECK_INTERVAL):
+                        # Idle: give handlers with unsynced writes a chance to fsync
+                        for handler in self._handlers:
+                            if handler._dirty and handler.fsync_policy != FSYNC_NONE \
+                                    and not handler._scheduled:
+                                handler._scheduled = True
+                                self._ready.append(handler)
+                if not self._ready:
+                    return  # Closing and nothing left to write
+                handler = self._ready.popleft()
+
+            handler._service()
+
+            with self._cond:
+                handler._scheduled = False
+            # Anything queued while we were writing (schedule() skipped it)
+            if handler._queue:
+                self.schedule(handler)
+
 
 class FileHandler:
-    def __init__(self, torrent, save_path):
+    """
+    Maps pieces onto the torrent's files and writes them from a background
+    thread (write-behind), so a slow disk never stalls the event loop.
+
+    write() only queues the piece. A writer thread (from 'disk_pool', or a
+    private one) takes everything that is queued, sorts it, merges pieces
+    that sit next to each other on disk into one positional write
+    (pwritev), and applies the fsync policy.
+    When more than 'max_pending_bytes' are waiting, 'is_backlogged' tells
+    the peers to stop requesting new blocks until the disk catches up.
+    Pieces passed to write() go back to 'buffer_pool' once they are on disk.
+    """
+
+    def __init__(self, torrent, save_path, max_pending_bytes=64 * 1024 * 1024,
+                 fsync_policy=FSYNC_INTERVAL, fsync_interval=5.0, disk_pool=None,
+                 buffer_pool=None):
         self.torrent = torrent
         self.save_path = save_path  # Now we store the user's chosen folder
-        self.descriptors = []
+        self.max_pending_bytes = max_pending_bytes
+        self.fsync_policy = fsync_policy
+        self.fsync_interval = fsync_interval
         self._open_files()
 
+        # Write-behind queue (shared with the writer thread)
+        self._queue = deque()  # (torrent offset, data)
+        self._unwritten = {}  # torrent offset -> piece data (queued whole pieces, for read())
+        self._cond = threading.Condition()
+        self._busy = False
+        self._closing = False  # New writes are dropped from here on
+        self._closed = False  # Files are (being) closed
+        self._scheduled = False  # Owned by the DiskPool
+        self.pending_bytes = 0
+        self.error = None
+
+        # Stats
+        self.bytes_written = 0
+        self.write_calls = 0
+        self._last_fsync = time.time()
+        self._dirty = False
+
+        self.read_cache = PieceCache(self)
+        self.buffer_pool = buffer_pool
+
+        self._own_pool = disk_pool is None
+        self.disk_pool = disk_pool or DiskPool(workers=1)
+        self.disk_pool.register(self)
+
     def _open_files(self):
         """Opens all files in the torrent for binary writing."""
         # Use the path the user selected + Torrent Name folder
@@ -17,6 +198,7 @@ class FileHandler:
 
         current_offset = 0
         self.files_info = []
+        self.has_existing_data = False
 
         for f in self.torrent.files:
             # Handle subfolders in multi-file torrents (replace backslashes for Windows)
@@ -26,14 +208,15 @@ class FileHandler:
             # Ensure subdirectories exist
             os.makedirs(os.path.dirname(full_path), exist_ok=True)
 
+            # Remember if there is old data on disk (worth a recheck)
+            if os.path.exists(full_path) and os.path.getsize(full_path) > 0:
+                self.has_existing_data = True
+
             # Create empty sparse files (Reserve space on disk)
-            if not os.path.exists(full_path):
-                with open(full_path, 'wb') as new_f:
-                    new_f.seek(f['length'] - 1)
-                    new_f.write(b'\0')
+            fd = os.open(full_path, OPEN_FLAGS, 0o644)
+            if os.fstat(fd).st_size != f['length']:
+                os.ftruncate(fd, f['length'])
 
-            # Open in Read/Write Binary mode
-            fd = open(full_path, 'rb+')
             self.files_info.append({
                 "fd": fd,
                 "start": current_offset,
@@ -42,27 +225,217 @@ class FileHandler:
             })
             current_offset += f['length']
 
+    # --- Event loop side ---
+
     def write(self, piece_index, data):
-        """Writes a downloaded piece to the correct location on disk."""
-        piece_start = piece_index * self.torrent.piece_length
-        piece_end = piece_start + len(data)
+        """
+        Queues a verified piece for writing. Never blocks.
+        'data' is reused for another piece once written, so it never goes
+        into the read cache: uploads get a copy from read() instead.
+        After close() the piece is dropped (and its buffer given back).
+        """
+        if not self._enqueue(piece_index * self.torrent.piece_length, data, whole_piece=True):
+            if self.buffer_pool is not None:
+                self.buffer_pool.release(data)
+
+    def write_block(self, piece_index, begin, data):
+        """Queues data that starts 'begin' bytes into a piece. Dropped after close()."""
+        self._enqueue(piece_index * self.torrent.piece_length + begin, data)
+
+    def _enqueue(self, offset, data, whole_piece=False):
+        if self.error is not None:
+            raise self.error
+        with self._cond:
+            if self._closing:
+                return False
+            if whole_piece:
+                self._unwritten[offset] = data
+            self._queue.append((offset, data))
+            self.pending_bytes += len(data)
+        self.disk_pool.schedule(self)
+        return True
+
+    @property
+    def is_backlogged(self):
+        return self.pending_bytes >= self.max_pending_bytes
+
+    def read(self, piece_index, begin=0, length=None):
+        """Reads a piece (or part of it). Pieces still waiting for the writer come from memory."""
+        if length is None:
+            length = self.torrent.piece_size(piece_index) - begin
+        with self._cond:
+            # Sliced under the lock: once written, the buffer is reused
+            pending = self._unwritten.get(piece_index * self.torrent.piece_length)
+            if pending is not None:
+                return pending[begin: begin + length]
+
+        piece_start = piece_index * self.torrent.piece_length + begin
+        piece_end = piece_start + length
+        chunks = []
 
         for f in self.files_info:
-            # Check if this file overlaps with the piece data
             if piece_end <= f["start"] or piece_start >= f["end"]:
                 continue
+            read_start = max(piece_start, f["start"])
+            read_end = min(piece_end, f["end"])
+            chunks.append(_pread(f["fd"], read_end - read_start, read_start - f["start"]))
 
-            # Calculate where to write in the file
-            write_start = max(piece_start, f["start"])
-            write_end = min(piece_end, f["end"])
-            write_len = write_end - write_start
+        return b"".join(chunks)
 
-            file_seek_pos = write_start - f["start"]
-            data_read_pos = write_start - piece_start
+    def file_stats(self):
+        """(size, mtime in ns) of every file. Used to validate fast-resume data."""
+        stats = []
+        for f in self.files_info:
+            st = os.fstat(f["fd"])
+            stats.append((st.st_size, st.st_mtime_ns))
+        return stats
 
-            f["fd"].seek(file_seek_pos)
-            f["fd"].write(data[data_read_pos: data_read_pos + write_len])
+    def flush(self):
+        """Blocks until everything queued is on disk, then fsyncs every file."""
+        with self._cond:
+            while self._queue or self._busy:
+                self._cond.wait()
+        for f in self.files_info:
+            os.fsync(f["fd"])
 
     def close(self):
+        with self._cond:
+            self._closing = True  # Late writes (a hash result after a stop) are dropped
+        self.flush()
+        with self._cond:
+            self._closed = True
+            while self._busy:  # A pool thread may still be in an fsync
+                self._cond.wait()
+        self.disk_pool.unregister(self)
+        if self._own_pool:
+            self.disk_pool.close()
+        for f in self.files_info:
+            os.close(f["fd"])
+
+    # --- Writer thread ---
+
+    def _service(self):
+        """Writes everything queued so far. Called by one DiskPool thread at a time."""
+        with self._cond:
+            if self._closed:
+                # Files are closed. Nothing can be queued after close(), but never
+                # leave anything behind: the DiskPool would reschedule us for it.
+                self._queue.clear()
+                return
+            batch = list(self._queue)
+            self._queue.clear()
+            self._busy = True
+
+        # The lock is not held here, so write() never waits for the disk
+        try:
+            if batch:
+                self._write_batch(batch)
+            self._maybe_fsync()
+        except OSError as e:
+            logger.error(f"Disk write failed: {e}")
+            self.error = e
+
+        written = []
+        with self._cond:
+            for offset, data in batch:
+                if self._unwritten.get(offset) is data:
+                    del self._unwritten[offset]
+                    written.append(data)
+            self.pending_bytes -= sum(len(data) for _, data in batch)
+            self._busy = False
+            self._cond.notify_all()
+        if self.buffer_pool is not None:
+            for data in written:
+                self.buffer_pool.release(data)
+
+    def _write_batch(self, batch):
+        """Coalesces pieces that are adjacent on disk into single writes."""
+        batch.sort(key=lambda item: item[0])
+        run_start = None
+        run_end = None
+        run = []
+
+        for offset, data in batch:
+            if run and offset == run_end:
+                run.append(data)
+                run_end += len(data)
+                continue
+            if run:
+                self._write_run(run_start, run)
+            run_start, run_end, run = offset, offset + len(data), [data]
+
+        if run:
+            self._write_run(run_start, run)
+
+    def _write_run(self, run_start, buffers):
+        """Writes contiguous torrent data starting at 'run_start' to every file it touches."""
+        run_end = run_start + sum(len(b) for b in buffers)
+
         for f in self.files_info:
-            f["fd"].close()
\ No newline at end of file
+            # Check if this file overlaps with the run
+            if run_end <= f["start"] or run_start >= f["end"]:
+                continue
+
+            # Slice out the buffers (zero-copy) that land inside this file
+            write_start = max(run_start, f["start"])
+            write_end = min(run_end, f["end"])
+            views = []
+            offset = run_start
+            for buf in buffers:
+                buf_end = offset + len(buf)
+                if buf_end > write_start and offset < write_end:
+                    lo = max(write_start, offset) - offset
+                    hi = min(write_end, buf_end) - offset
+                    views.append(memoryview(buf)[lo:hi])
+                offset = buf_end
+
+            self._pwritev(f["fd"], views, write_start - f["start"])
+
+    def _pwritev(self, fd, views, position):
+        """Positional vectored write that copes with short writes and platforms without pwritev."""
+        while views:
+            chunk = views[:IOV_MAX]
+            if hasattr(os, "pwritev"):
+                written = os.pwritev(fd, chunk, position)
+            else:
+                written = _pwrite(fd, b"".join(chunk), position)
+            self.write_calls += 1
+            self.bytes_written += written
+            self._dirty = True
+            position += written
+
+            # Drop what has been written (short writes are rare but legal)
+            while views and written >= len(views[0]):
+                written -= len(views[0])
+                views.pop(0)
+            if written:
+                views[0] = views[0][written:]
+
+    def _maybe_fsync(self):
+        if not self._dirty or self.fsync_policy == FSYNC_NONE:
+            return
+        now = time.time()
+        if self.fsync_policy == FSYNC_INTERVAL and now - self._last_fsync < self.fsync_interval:
+            return
+        for f in self.files_info:
+            os.fsync(f["fd"])
+        self._last_fsync = now
+        self._dirty = False
+
+
+if hasattr(os, "pwrite"):
+    _pwrite = os.pwrite
+    _pread = os.pread
+else:
+    _seek_lock = threading.Lock()
+
+    def _pwrite(fd, data, position):
+        # Windows has no pwrite: seek + write under a lock does the same job
+        with _seek_lock:
+            os.lseek(fd, position, os.SEEK_SET)
+            return os.write(fd, data)
+
+    def _pread(fd, length, position):
+        with _seek_lock:
+            os.lseek(fd, position, os.SEEK_SET)
+            return os.read(fd, length)
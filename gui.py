@@ -5,10 +5,11 @@ from PIL import Image, ImageTk
 import threading
 import asyncio
 import os
+import queue
 import shutil
 import psutil  # For System Stats
 import time
-from client import TorrentClient
+from session import Session
 
 # ==========================================
 # 🎨 ANIME CYBERPUNK THEME ENGINE
@@ -131,9 +132,12 @@ class FluxAnimeGUI(ctk.CTk):
         self.geometry("1100x750")
 
         # State
-        self.client = None
-        self.is_running = False
+        self.session = None  # Every torrent runs in one Session, on one engine thread
+        self.is_paused = False
         self.bg_ref = None
+        # Stats snapshots from the engine thread (never read its live objects from here)
+        self.stats_queue = queue.SimpleQueue()
+        self.last_stats = None
 
         # --- LAYER 0: Background ---
         self.grid_rowconfigure(0, weight=1)
@@ -197,7 +201,7 @@ class FluxAnimeGUI(ctk.CTk):
                                       font=("Consolas", 16), text_color="gray")
         self.empty_msg.pack(pady=100)
 
-        self.active_card = None  # Supports 1 download for this demo
+        self.cards = {}  # info-hash -> TorrentDisplayCard
 
         # === LOG TERMINAL (Bottom) ===
         self.terminal = GlassCard(self.wrapper, height=150)
@@ -262,56 +266,63 @@ class FluxAnimeGUI(ctk.CTk):
         self.start_engine(f, d)
 
     def start_engine(self, f, d):
-        if self.is_running: return
-
         self.empty_msg.pack_forget()  # Hide placeholder
 
-        self.client = TorrentClient(f, d)
-        self.is_running = True
-
-        # Create Card
-        size_mb = self.client.torrent.total_length / (1024 * 1024)
-        self.active_card = TorrentDisplayCard(self.content_area, self.client.torrent.name, f"{size_mb:.2f} MB")
-        self.log(f"INITIATING DOWNLOAD: {self.client.torrent.name}")
+        if self.session is None:
+            self.session = Session(d, stats_queue=self.stats_queue)
+            self.session.add(f, d)
 
-        # Start Backend
-        t = threading.Thread(target=self._run_async, daemon=True)
-        t.start()
+            # Start Backend
+            t = threading.Thread(target=self._run_async, daemon=True)
+            t.start()
+        else:
+            # The engine loop owns the session now: hand the call over
+            self.session.run_threadsafe(self.session.add, f, d)
+        # The card shows up with the first stats snapshot that has the torrent
 
     def _run_async(self):
-        asyncio.run(self.client.start())
+        asyncio.run(self.session.run())
 
     def toggle_pause(self):
-        if self.client:
-            self.client.toggle_pause()
-            state = "PAUSED" if self.client.is_paused else "RESUMED"
+        if self.session and self.session.loop:
+            self.is_paused = not self.is_paused
+            action = self.session.pause if self.is_paused else self.session.resume
+            for info_hash in self.cards:
+                self.session.run_threadsafe(action, info_hash)
+            state = "PAUSED" if self.is_paused else "RESUMED"
             self.log(f"OPERATION {state}")
 
     def update_torrent_ui(self):
-        if self.client and self.is_running and self.active_card:
-            # Stats Math
-            completed = sum(
-                (self.client.piece_manager.bitfield.field[i // 8] >> (7 - (i % 8))) & 1
-                for i in range(self.client.torrent.number_of_pieces)
-            )
-            total = self.client.torrent.number_of_pieces
-            pct = completed / total if total > 0 else 0
+        # Apply everything the engine published since the last frame (only the newest matters)
+        while True:
+            try:
+                self.last_stats = self.stats_queue.get_nowait()
+            except queue.Empty:
+                break
 
-            peers = len(self.client.peers)
+        if self.last_stats:
+            for stats in self.last_stats["torrents"]:
+                card = self.cards.get(stats["info_hash"])
+                if card is None:
+                    size_mb = stats["size"] / (1024 * 1024)
+                    card = TorrentDisplayCard(self.content_area, stats["name"], f"{size_mb:.2f} MB")
+                    self.cards[stats["info_hash"]] = card
+                    self.log(f"INITIATING DOWNLOAD: {stats['name']}")
 
-            # Simulated Speed (Byte delta calculation would be better, but this is visual)
-            # In a real app, calculate (bytes_now - bytes_last_sec)
-            est_speed = peers * 15  # Conservative estimate for visual
-            if self.client.is_paused: est_speed = 0
+                pct = stats["pieces_done"] / stats["pieces_total"] if stats["pieces_total"] > 0 else 0
+                state = stats["state"]
 
-            status = "DOWNLOADING PACKETS..."
-            if self.client.is_paused: status = "SYSTEM PAUSED"
-            if pct >= 1.0: status = "TASK COMPLETED"
+                # Real payload rate (smoothed), measured at the sockets
+                speed = stats["download_rate"] / 1024 if state == "downloading" else 0
 
-            self.active_card.update(pct, f"{est_speed} KB/s", peers, status)
+                status = "DOWNLOADING PACKETS..."
+                if state == "queued": status = "WAITING IN QUEUE..."
+                if state == "paused": status = "SYSTEM PAUSED"
+                if pct >= 1.0: status = "TASK COMPLETED"
 
-        self.after(800, self.update_torrent_ui)
+                card.update(pct, f"{speed:.0f} KB/s", stats["peers"], status)
 
+        self.after(800, self.update_torrent_ui)
 
 if __name__ == "__main__":
     app = FluxAnimeGUI()
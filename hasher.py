@@ -0,0 +1,76 @@
+import asyncio
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from utils import sha1_hash
+
+
+def _hash_job(data, submitted_at):
+    """Runs inside a worker. Returns the digest and when the job actually started."""
+    started_at = time.time()
+    return sha1_hash(data), started_at - submitted_at
+
+
+class HashPool:
+    """
+    Verifies pieces off the event loop.
+    hashlib releases the GIL for big buffers, so plain threads already use
+    every core. Processes are available for interpreters where that is not
+    true (the piece data is then copied to the worker).
+
+    At most 'max_pending' pieces can wait for a worker. When the queue is
+    full, submit() blocks the calling peer, which stops reading its socket
+    and lets TCP slow the sender down.
+    """
+
+    def __init__(self, workers=None, use_processes=False, max_pending=None):
+        self.workers = workers or os.cpu_count() or 1
+        executor_class = ProcessPoolExecutor if use_processes else ThreadPoolExecutor
+        self.executor = executor_class(max_workers=self.workers)
+
+        self.max_pending = max_pending or self.workers * 4
+        self._slots = asyncio.Semaphore(self.max_pending)
+        self.pending = 0
+
+        # Stats: how long pieces sit in the queue before a worker picks them up
+        self.jobs_done = 0
+        self.queue_latency = 0.0  # seconds (smoothed)
+        self.max_queue_latency = 0.0
+
+    async def submit(self, data):
+        """
+        Queues 'data' for hashing. Waits for a free slot first (backpressure),
+        then returns a future that resolves to the SHA-1 digest.
+        """
+        await self._slots.acquire()
+        self.pending += 1
+
+        loop = asyncio.get_running_loop()
+        job = loop.run_in_executor(self.executor, _hash_job, data, time.time())
+        result = loop.create_future()
+        job.add_done_callback(lambda f: self._job_done(f, result))
+        return result
+
+    def _job_done(self, job, result):
+        self.pending -= 1
+        self._slots.release()
+
+        if job.cancelled():
+            result.cancel()
+            return
+        if job.exception() is not None:
+            if not result.done():
+                result.set_exception(job.exception())
+            return
+
+        digest, waited = job.result()
+        self.jobs_done += 1
+        self.queue_latency = waited if self.jobs_done == 1 else 0.9 * self.queue_latency + 0.1 * waited
+        self.max_queue_latency = max(self.max_queue_latency, waited)
+        # The caller may have given up on it (cancelled recheck, Ctrl-C)
+        if result.done():
+            return
+        result.set_result(digest)
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
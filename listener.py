@@ -0,0 +1,97 @@
+import asyncio
+from peer import PeerConnection
+from wire import WireProtocol
+from utils import logger
+
+LISTEN_PORT = 6881
+
+
+class PeerListener:
+    """
+    Accepts incoming peer connections on one TCP port for every torrent.
+    It is the WireProtocol handler until the handshake (the first 68 bytes)
+    arrives. Its info-hash picks the torrent, whose PeerConnection then
+    takes the connection over. Connections are refused when the torrent is unknown or not
+    running, when it (or the whole listener) is at its connection limit,
+    or when we are already talking to that IP for that torrent.
+    """
+
+    def __init__(self, port=LISTEN_PORT, max_connections=None, host="0.0.0.0"):
+        self.host = host
+        self.port = port  # 0 = any free port; the real one is set by start()
+        self.max_connections = max_connections  # None = only per-torrent limits
+        self.torrents = {}  # info_hash -> TorrentClient
+        self.server = None
+
+        # Stats
+        self.accepted = 0
+        self.rejected = 0
+
+    def add_torrent(self, client):
+        self.torrents[client.torrent.info_hash] = client
+
+    def remove_torrent(self, info_hash):
+        self.torrents.pop(info_hash, None)
+
+    async def start(self):
+        loop = asyncio.get_running_loop()
+        self.server = await loop.create_server(lambda: WireProtocol(self), self.host, self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+        logger.info(f"Listening for peers on port {self.port}")
+
+    async def close(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+
+    # --- WireProtocol callbacks (until a PeerConnection takes over) ---
+
+    def connection_made(self, wire):
+        pass  # Nothing to say before we know the torrent
+
+    def handshake_received(self, wire, handshake):
+        ip, port = wire.transport.get_extra_info("peername")[:2]
+        client = self._route(ip, handshake)
+        if client is None:
+            self.rejected += 1
+            wire.close()
+            return
+
+        self.accepted += 1
+        peer = PeerConnection(
+            ip, port, client.torrent, client.peer_id,
+            client.piece_manager, client.file_handler, client.hash_pool
+        )
+        # No CandidatePool entry: 'port' is where the peer connected from, not
+        # where it listens, so it is not worth dialing later
+        peer.client = client
+        client.peers.append(peer)
+        peer.accept(wire)
+
+    def message_received(self, msg_id, payload):
+        pass  # Only reached after a rejected handshake, the connection is closing
+
+    def connection_lost(self, exc):
+        pass  # Gone before (or without) a handshake
+
+    def _route(self, ip, handshake):
+        if handshake[1:20] != b"BitTorrent protocol":
+            return None
+        client = self.torrents.get(handshake[28:48])
+        if client is None or not client.accepting or client.is_paused:
+            return None
+        if handshake[48:68] == client.peer_id:
+            return None  # Ourselves (our own announce came back from the tracker)
+
+        # Limits: per torrent, then across every torrent on this port
+        if len(client.peers) >= client.max_peers:
+            return None
+        if self.max_connections is not None and \
+                sum(len(c.peers) for c in self.torrents.values()) >= self.max_connections:
+            return None
+
+        # Already connected (or dialing) to this IP: keep that connection
+        if any(p.ip == ip and not p.closed for p in client.peers):
+            return None
+        return client
@@ -1,12 +1,40 @@
+import time
+STARTED = time.perf_counter()  # Before any other import, so startup time includes them all
+
+import argparse
 import logging
 # Silence noisy libraries so the terminal stays clean
 logging.getLogger("urllib3").setLevel(logging.WARNING)
 logging.getLogger("requests").setLevel(logging.WARNING)
 
-# IMPORT THE NEW CLASS NAME HERE
-from gui import FluxAnimeGUI
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="FluxTorrent")
+    parser.add_argument("torrents", nargs="*", help=".torrent files to download (headless). Omit to open the GUI.")
+    parser.add_argument("-o", "--output", default=".", help="Download folder (default: current folder)")
+    parser.add_argument("--seed", action="store_true", help="Keep seeding after the download completes")
+    parser.add_argument("--max-active", type=int, default=3, help="Torrents downloading at once (default: 3)")
+    parser.add_argument("--download-limit", type=int, default=0, metavar="KB/S", help="0 = unlimited")
+    parser.add_argument("--port", type=int, default=6881, help="Port for incoming peer connections (default: 6881)")
+    parser.add_argument("--upload-limit", type=int, default=0, metavar="KB/S", help="0 = unlimited")
+    parser.add_argument("--memory", type=int, default=256, metavar="MB",
+                        help="Piece data kept in memory, all torrents together (default: 256)")
+    parser.add_argument("-q", "--quiet", action="store_true", help="No progress output")
+    parser.add_argument("-v", "--verbose", action="store_true", help="Debug logging")
+    return parser.parse_args(argv)
+
 
 if __name__ == "__main__":
-    # Initialize the Ultimate Anime Interface
-    app = FluxAnimeGUI()
-    app.mainloop()
\ No newline at end of file
+    args = parse_args()
+
+    if args.torrents:
+        # Headless: nothing from the GUI stack (tkinter, customtkinter, PIL, psutil) gets imported
+        from cli import run
+        run(args, STARTED)
+    else:
+        # IMPORT THE NEW CLASS NAME HERE
+        from gui import FluxAnimeGUI
+
+        # Initialize the Ultimate Anime Interface
+        app = FluxAnimeGUI()
+        app.mainloop()
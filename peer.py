@@ -1,204 +1,513 @@
 import asyncio
 import struct
 import time
-import random
-from utils import logger, sha1_hash
-
-BLOCK_SIZE = 16384  # 16KB
+from collections import deque
+from piece_manager import BLOCK_SIZE
+from stats import TrafficCounters
+from utils import logger
+from wire import WireProtocol
+
+# Pipeline depth (outstanding block requests per peer)
+INITIAL_QUEUE_DEPTH = 16
+MIN_QUEUE_DEPTH = 4
+MAX_QUEUE_DEPTH = 500  # ~8MB in flight per peer
+RATE_WINDOW = 1.0  # seconds between queue depth updates
+READ_TIMEOUT = 15  # seconds of silence before we give up on a peer
+
+# Block requests: a request older than srtt + 4 x deviation (of this peer's
+# block latency) has timed out and its block is handed to other peers
+INITIAL_REQUEST_TIMEOUT = 10  # seconds, until we have a latency sample
+MIN_REQUEST_TIMEOUT = 2
+MAX_REQUEST_TIMEOUT = 30
+REQUEST_CHECK_INTERVAL = 1.0  # seconds
+
+# Upload side
+MAX_UPLOAD_QUEUE = 64  # Requests we hold per peer; more than that are ignored
+MAX_REQUEST_LENGTH = 128 * 1024  # Bigger requests are a protocol violation
 
 
 class PeerConnection:
-    def __init__(self, ip, port, torrent, peer_id, piece_manager, file_handler):
+    def __init__(self, ip, port, torrent, peer_id, piece_manager, file_handler, hash_pool):
         self.ip = ip
         self.port = port
         self.torrent = torrent
         self.my_peer_id = peer_id
         self.piece_manager = piece_manager
         self.file_handler = file_handler
+        self.hash_pool = hash_pool
 
-        self.reader = None
-        self.writer = None
+        self.wire = None  # WireProtocol, once connected
+        self.transport = None
         self.peer_choking = True
         self.am_interested = False
+        self.am_choking = True
+        self.peer_interested = False
+        self.snubbed = False
 
         self.peer_pieces = [False] * torrent.number_of_pieces
-        self.current_piece_index = None
-        self.current_piece_buffer = {}
-        self.request_pending = False
+
+        # Request pipeline (the blocks themselves live in the PieceManager)
+        self.outstanding = {}  # (index, begin) -> time the request was sent (in send order)
+        self._timed_out = set()  # Requests we gave up on (still welcome if they arrive)
+        self.block_rtt = None  # Smoothed block latency, seconds
+        self.block_rtt_var = 0.0
+        self.request_timeouts = 0
+        self.queue_depth = INITIAL_QUEUE_DEPTH
+        self.min_rtt = None
+        self._depth_updated_at = time.time()
         self.last_activity = time.time()
+        self.last_block_time = time.time()
+
+        # Upload queue: (index, begin, length) requested by the peer
+        self.upload_queue = deque()
+        self._upload_wakeup = asyncio.Event()
+        self._upload_task = None
+
+        # Bytes on the wire, payload and protocol overhead (chained to the torrent's)
+        self.traffic = TrafficCounters()
 
         self.client = None
+        self.candidate = None  # Our entry in the client's CandidatePool
+        self.connected_at = time.time()
+        self.handshaken = False
+        self.incoming = False  # The peer connected to us
         self.closed = False
+        self._handshake = None  # Future, set when the peer's handshake checks out
 
     async def start(self):
+        dialer = self.client.dialer if self.client else None
+        if self.client:
+            self.traffic.parent = self.client.traffic
+        loop = asyncio.get_running_loop()
+        self._handshake = loop.create_future()
+        protocol = lambda: WireProtocol(self)
         try:
-            self.reader, self.writer = await asyncio.wait_for(
-                asyncio.open_connection(self.ip, self.port, limit=2 ** 18),
-                timeout=5
-            )
-            await self._perform_handshake()
+            if dialer:
+                priority = self.candidate.score if self.candidate else 0
+                await dialer.connect(self.ip, self.port, protocol, priority)
+            else:
+                await asyncio.wait_for(loop.create_connection(protocol, self.ip, self.port), timeout=5)
+            self.connected_at = time.time()
+            try:
+                await self._handshake  # Ours went out in connection_made()
+            except Exception:
+                if dialer:
+                    dialer.record_handshake(0, ok=False)
+                raise
+            if dialer:
+                dialer.record_handshake(time.time() - self.connected_at)
             await self._message_loop()
         except Exception:
             pass
         finally:
             self.close()
 
-    async def _perform_handshake(self):
+    def accept(self, wire):
+        """
+        Takes over a connection the peer opened to us. The listener has
+        already checked its handshake, so we answer with ours.
+        """
+        self.incoming = True
+        if self.client:
+            self.traffic.parent = self.client.traffic
+        wire.handler = self
+        self.connection_made(wire)
+        self.traffic.received(0, 68)
+        self._after_handshake()
+        asyncio.create_task(self._serve())
+
+    async def _serve(self):
+        try:
+            await self._message_loop()
+        finally:
+            self.close()
+
+    # --- WireProtocol callbacks ---
+
+    def connection_made(self, wire):
+        self.wire = wire
+        self.transport = wire.transport
+        if self.closed:  # Closed while we were dialing
+            wire.close()
+            return
         pstr = b"BitTorrent protocol"
         handshake = struct.pack(
             f'>B{len(pstr)}s8s20s20s',
             len(pstr), pstr, b'\x00' * 8, self.torrent.info_hash, self.my_peer_id
         )
-        self.writer.write(handshake)
-        await self.writer.drain()
-
-        await self.reader.readexactly(68)
-        await self._send_message(2)
-        self.am_interested = True
-
-    async def _message_loop(self):
-        while True:
-            try:
-                length_data = await asyncio.wait_for(self.reader.readexactly(4), timeout=15)
-            except:
-                return
+        self.transport.write(handshake)
+        self.traffic.sent(0, len(handshake))
 
-            length = struct.unpack('>I', length_data)[0]
-            if length == 0: continue
+    def handshake_received(self, wire, handshake):
+        self.traffic.received(0, 68)
+        if self.closed or self._handshake.done():
+            return
+        if handshake[1:20] != b"BitTorrent protocol" or handshake[28:48] != self.torrent.info_hash:
+            self._handshake.set_exception(ConnectionError("Bad handshake"))
+            wire.close()
+            return
+        self._after_handshake()
+        self._handshake.set_result(None)
 
-            msg_id = ord(await self.reader.readexactly(1))
+    def connection_lost(self, exc):
+        if self._handshake and not self._handshake.done():
+            self._handshake.set_exception(ConnectionError("Connection lost during handshake"))
+        self.close()
 
-            payload = b""
-            if length > 1:
-                payload = await self.reader.readexactly(length - 1)
+    def message_received(self, msg_id, payload):
+        """
+        Called by the WireProtocol for every message. 'payload' is a view into
+        its receive buffer, only valid during this call (or until the returned
+        awaitable is done).
+        """
+        self.last_activity = time.time()
+        if msg_id is None:
+            self.traffic.received(0, 4)  # Keep-alive
+            return None
 
-            self.last_activity = time.time()
-            await self._handle_message(msg_id, payload)
+        length = len(payload) + 1
+        if msg_id == 7 and length > 9:
+            self.traffic.received(length - 9, 13)  # Block data vs. header
+        else:
+            self.traffic.received(0, length + 4)
+
+        # Rate limit at the socket: reading stops until the grant, TCP slows the
+        # sender down. One grant per message, so only block-sized messages really wait.
+        if self.client and length > 13 and self.client.bandwidth.download_limited:
+            return self._throttled(msg_id, payload, length)
+        return self._handle_message(msg_id, payload)
+
+    async def _throttled(self, msg_id, payload, length):
+        await self.client.bandwidth.download(length + 4)
+        # Churn, eviction or a read timeout may have closed us while we waited
+        if self.closed:
+            return
+        pending = self._handle_message(msg_id, payload)
+        if pending is not None:
+            await pending
+
+    def _after_handshake(self):
+        # Tell the peer what we can give it, then what we want
+        if self.piece_manager.have_count:
+            self.transport.write(self._message(5, bytes(self.piece_manager.bitfield.field)))
+        if not self.piece_manager.complete:
+            self.transport.write(self._message(2))
+            self.am_interested = True
+        self.handshaken = True
+        self._upload_task = asyncio.create_task(self._upload_loop())
 
-    async def _handle_message(self, msg_id, payload):
+    async def _message_loop(self):
+        """
+        Messages are handled by the WireProtocol as they arrive. This waits
+        for the connection to end, checks the block requests for timeouts,
+        and ends the connection after READ_TIMEOUT seconds without a single
+        message.
+        """
+        while not self.wire.lost.done():
+            try:
+                await asyncio.wait_for(asyncio.shield(self.wire.lost), timeout=REQUEST_CHECK_INTERVAL)
+            except asyncio.TimeoutError:
+                now = time.time()
+                if now - self.last_activity >= READ_TIMEOUT:
+                    return
+                self._check_request_timeouts(now)
+
+    def _handle_message(self, msg_id, payload):
+        """Returns an awaitable when the message needs more work (a finished piece)."""
         if msg_id == 0:  # Choke
             self.peer_choking = True
+            self._release_outstanding()
         elif msg_id == 1:  # Unchoke
             self.peer_choking = False
-            await self._request_piece()
+            self._request_piece()
+
+        elif msg_id == 2:  # Interested
+            self.peer_interested = True
+            # Free slot: unchoke now. Otherwise the Choker decides next round.
+            if self.am_choking and self.client and self.client.choker.has_free_slot():
+                self.set_choking(False)
+        elif msg_id == 3:  # Not Interested
+            self.peer_interested = False
 
         elif msg_id == 4:  # Have
             piece_index = struct.unpack('>I', payload)[0]
-            if piece_index < len(self.peer_pieces):
+            if piece_index < len(self.peer_pieces) and not self.peer_pieces[piece_index]:
                 self.peer_pieces[piece_index] = True
+                self.piece_manager.peer_has(self, piece_index)
+            if not self.peer_choking:
+                self._request_piece()
 
         elif msg_id == 5:  # Bitfield
-            byte_index = 0
-            bit_index = 0
-            for i in range(len(self.peer_pieces)):
-                if byte_index < len(payload):
-                    if (payload[byte_index] >> (7 - bit_index)) & 1:
-                        self.peer_pieces[i] = True
-                    bit_index += 1
-                    if bit_index == 8:
-                        bit_index = 0
-                        byte_index += 1
+            new_pieces = []
+            for i in range(min(len(self.peer_pieces), len(payload) * 8)):
+                if (payload[i >> 3] >> (7 - (i & 7))) & 1 and not self.peer_pieces[i]:
+                    self.peer_pieces[i] = True
+                    new_pieces.append(i)
+            self.piece_manager.add_peer_pieces(self, new_pieces)
             if not self.peer_choking:
-                await self._request_piece()
-
-        elif msg_id == 7:  # Piece Data
-            await self._handle_block(payload)
+                self._request_piece()
 
-    def _get_valid_piece_index(self):
-        """
-        SMART SELECTION LOGIC:
-        1. Check Missing Pieces (Random Order).
-        2. Check Endgame (Double Download).
-        """
-        # 1. Standard: Find a missing piece that no one else is doing
-        for piece_idx in self.piece_manager.missing_pieces:
-            if self.peer_pieces[piece_idx]:
-                if piece_idx not in self.piece_manager.ongoing_pieces:
-                    self.piece_manager.ongoing_pieces.append(piece_idx)
-                    return piece_idx
+        elif msg_id == 6:  # Request
+            self._queue_upload(payload)
 
-        # 2. ENDGAME: If we found nothing above, AND we are in endgame mode...
-        if self.piece_manager.is_endgame:
-            # Look at what OTHER peers are downloading right now
-            candidates = [p for p in self.piece_manager.ongoing_pieces if self.peer_pieces[p]]
-            if candidates:
-                # Pick one and help them finish it! (Race Condition)
-                return random.choice(candidates)
+        elif msg_id == 7:  # Piece Data
+            return self._handle_block(payload)
 
+        elif msg_id == 8:  # Cancel
+            request = struct.unpack('>III', payload[:12])
+            try:
+                self.upload_queue.remove(request)
+            except ValueError:
+                pass  # Already sent (or never queued)
         return None
 
-    async def _request_piece(self):
+    def _request_piece(self):
+        """
+        Keeps the request pipeline full. Up to 'queue_depth' block requests
+        are outstanding at once, spanning as many pieces as needed, so the
+        link never goes idle at a piece boundary.
+        """
         if hasattr(self, 'client') and self.client and self.client.is_paused:
             return
 
-        if self.peer_choking or self.request_pending: return
+        if self.peer_choking or self.closed: return
 
-        index = self._get_valid_piece_index()
-        if index is None: return
+        # Disk is behind: don't pull in more data until the writer catches up
+        if self.file_handler.is_backlogged: return
 
-        self.current_piece_index = index
-        self.current_piece_buffer = {}
-        self.request_pending = True
+        wanted = self.queue_depth - len(self.outstanding)
+        if wanted <= 0: return
 
-        piece_length = self.torrent.piece_length
-        if index == self.torrent.number_of_pieces - 1:
-            remainder = self.torrent.total_length % self.torrent.piece_length
-            if remainder: piece_length = remainder
+        # The PieceManager decides which blocks: started pieces first,
+        # then rarest-first new pieces, then endgame duplicates.
+        blocks = self.piece_manager.next_blocks(self, self.peer_pieces, wanted)
+        if not blocks: return
 
-        # Zero-Wait Pipelining
-        buffer_reqs = b""
-        for begin in range(0, piece_length, BLOCK_SIZE):
-            length = min(BLOCK_SIZE, piece_length - begin)
-            req_header = struct.pack('>IBIII', 13, 6, index, begin, length)
-            buffer_reqs += req_header
+        buffer_reqs = bytearray()
+        now = time.time()
+        for index, begin, length in blocks:
+            self.outstanding[(index, begin)] = now
+            buffer_reqs += struct.pack('>IBIII', 13, 6, index, begin, length)
+        self.transport.write(buffer_reqs)
+        self.traffic.sent(0, len(buffer_reqs))
 
-        self.writer.write(buffer_reqs)
+    def cancel_block(self, index, begin, length):
+        """Another peer delivered this block first: take our request back."""
+        key = (index, begin)
+        if self.outstanding.pop(key, None) is None:
+            if key not in self._timed_out:
+                return
+            self._timed_out.discard(key)
+        if self.transport and not self.closed:
+            self.transport.write(self._message(8, struct.pack('>III', index, begin, length)))
+            self._request_piece()  # Room in the pipeline again
 
-    async def _handle_block(self, payload):
-        try:
-            index, begin = struct.unpack('>II', payload[:8])
-            block_data = payload[8:]
+    def _release_outstanding(self):
+        """
+        A choke (or disconnect) silently discards every request we sent.
+        Hand the blocks back so any peer can fetch them.
+        """
+        self.piece_manager.release_blocks(self, list(self.outstanding))
+        self.outstanding.clear()
+        self._timed_out.clear()
+
+    @property
+    def request_timeout(self):
+        """Seconds a block request may take, from this peer's block latency (like TCP's RTO)."""
+        if self.block_rtt is None:
+            return INITIAL_REQUEST_TIMEOUT
+        timeout = self.block_rtt + 4 * self.block_rtt_var
+        return max(MIN_REQUEST_TIMEOUT, min(MAX_REQUEST_TIMEOUT, timeout))
+
+    def _check_request_timeouts(self, now):
+        """
+        Requests the peer sat on for too long (dropped, or stuck behind a
+        stalled upload) go back to the PieceManager for other peers to
+        fetch. If the block shows up after all, it is still used.
+        """
+        timeout = self.request_timeout
+        expired = []
+        for key, sent_at in self.outstanding.items():
+            if now - sent_at < timeout:
+                break  # In send order: the rest are younger
+            expired.append(key)
+        if not expired:
+            return
 
-            if index != self.current_piece_index: return
+        for key in expired:
+            del self.outstanding[key]
+        self._timed_out.update(expired)
+        self.request_timeouts += len(expired)
+        self.piece_manager.blocks_timed_out(self, expired)
+        # Slow down: only a few requests at a time until blocks flow again
+        self.queue_depth = MIN_QUEUE_DEPTH
+        logger.debug(f"{self.ip}: {len(expired)} requests timed out after {timeout:.1f}s")
 
-            self.current_piece_buffer[begin] = block_data
+    def _update_queue_depth(self, sent_at):
+        """
+        Adapts the pipeline depth to the bandwidth-delay product of this peer:
+        depth = download rate x round trip time, in blocks (with 2x headroom).
+        Also keeps the smoothed block latency the request timeout is based on.
+        """
+        now = time.time()
+        latency = now - sent_at
+        if self.min_rtt is None or latency < self.min_rtt:
+            self.min_rtt = latency
+        if self.block_rtt is None:
+            self.block_rtt, self.block_rtt_var = latency, latency / 2
+        else:
+            self.block_rtt_var = 0.75 * self.block_rtt_var + 0.25 * abs(self.block_rtt - latency)
+            self.block_rtt = 0.875 * self.block_rtt + 0.125 * latency
 
-            piece_length = self.torrent.piece_length
-            if index == self.torrent.number_of_pieces - 1:
-                remainder = self.torrent.total_length % self.torrent.piece_length
-                if remainder: piece_length = remainder
+        if now - self._depth_updated_at < RATE_WINDOW:
+            return
+        self._depth_updated_at = now
 
-            current_size = sum(len(b) for b in self.current_piece_buffer.values())
+        bdp_blocks = int(2 * self.download_rate * self.min_rtt / BLOCK_SIZE)
+        self.queue_depth = max(MIN_QUEUE_DEPTH, min(MAX_QUEUE_DEPTH, bdp_blocks))
+        # Forget the old minimum slowly so a route change is picked up
+        self.min_rtt *= 1.1
 
-            if current_size == piece_length:
-                self._verify_and_write(index)
-                self.request_pending = False
-                await self._request_piece()
-        except:
-            self.request_pending = False
+    def _handle_block(self, payload):
+        try:
+            index, begin = struct.unpack_from('>II', payload)
+            block_data = payload[8:]  # Still a view into the receive buffer
+
+            sent_at = self.outstanding.pop((index, begin), None)
+            if sent_at is not None:
+                self._update_queue_depth(sent_at)
+            elif (index, begin) in self._timed_out:
+                self._timed_out.discard((index, begin))  # Late, but still useful
+            else:
+                # Not something we asked for (or cancelled: in flight before the cancel got there)
+                self.piece_manager.wasted_bytes += len(block_data)
+                return None
+            self.last_block_time = time.time()
+
+            piece = self.piece_manager.block_received(self, index, begin, block_data)
+            if piece is not None:
+                return self._verify_and_write(piece)
+
+            self._request_piece()
+        except Exception:
+            logger.debug(f"Bad block from {self.ip}", exc_info=True)
+        return None
 
-    def _verify_and_write(self, index):
-        data = b"".join(
-            self.current_piece_buffer[begin]
-            for begin in sorted(self.current_piece_buffer.keys())
-        )
-        expected_hash = self.torrent.pieces_hashes[index]
-        if sha1_hash(data) == expected_hash:
-            self.file_handler.write(index, data)
+    async def _verify_and_write(self, piece):
+        """
+        Sends the piece to the hash workers (the result is handled in the loop),
+        then asks for more. Reading waits meanwhile, so a full hash queue
+        slows the peer down.
+        """
+        data = piece.data()
+        job = await self.hash_pool.submit(data)
+        job.add_done_callback(lambda f: self._piece_hashed(piece.index, data, f))
+        if self.client:
+            self.client.hash_jobs.add(job)
+            job.add_done_callback(self.client.hash_jobs.discard)
+        self._request_piece()
+
+    def _piece_hashed(self, index, data, job):
+        if self.client and self.client.stopped:
+            # Too late: the torrent was stopped, its resume data is saved and
+            # its files may be closed. The piece is fetched again next time.
+            self.piece_manager.drop_piece(index)
+            return
+        if not job.cancelled() and job.exception() is None \
+                and job.result() == self.torrent.pieces_hashes[index]:
+            try:
+                self.file_handler.write(index, data)
+            except OSError:
+                # The disk failed (file_handler.error): the client stops the torrent
+                self.piece_manager.drop_piece(index)
+                return
             self.piece_manager.mark_piece_complete(index)
+            if self.client:
+                self.client.broadcast_have(index)
         else:
             self.piece_manager.mark_piece_failed(index)
 
-    async def _send_message(self, msg_id, payload=b''):
-        length = 1 + len(payload)
-        header = struct.pack('>IB', length, msg_id)
-        self.writer.write(header + payload)
-        await self.writer.drain()
+    # --- Upload path ---
+
+    def set_choking(self, choking):
+        """Chokes or unchokes the peer. Choking drops everything it asked for."""
+        if choking == self.am_choking or self.closed:
+            return
+        self.am_choking = choking
+        if choking:
+            self.upload_queue.clear()
+        # No drain: one slow peer must not hold up a whole rechoke round
+        self.transport.write(self._message(0 if choking else 1))
+
+    def send_have(self, index):
+        if self.transport and not self.closed:
+            self.transport.write(self._message(4, struct.pack('>I', index)))
+
+    def _queue_upload(self, payload):
+        index, begin, length = request = struct.unpack('>III', payload[:12])
+        if self.am_choking or len(self.upload_queue) >= MAX_UPLOAD_QUEUE:
+            return
+        if index >= self.torrent.number_of_pieces or not self.piece_manager.bitfield.has_piece(index):
+            return
+        if length == 0 or length > MAX_REQUEST_LENGTH or begin + length > self.torrent.piece_size(index):
+            return
+        self.upload_queue.append(request)
+        self._upload_wakeup.set()
+
+    async def _upload_loop(self):
+        """Serves queued requests one at a time, straight out of the piece cache."""
+        cache = self.file_handler.read_cache
+        while not self.closed:
+            if not self.upload_queue or (self.client and self.client.is_paused):
+                self._upload_wakeup.clear()
+                await self._upload_wakeup.wait()
+                continue
+
+            index, begin, length = self.upload_queue.popleft()
+            piece = await cache.get(index)
+            if self.am_choking or self.closed:
+                continue
+
+            if self.client:
+                await self.client.bandwidth.upload(13 + length)
+
+            # The block is a slice of the cached piece: no copy until the socket
+            self.transport.write(struct.pack('>IBII', 9 + length, 7, index, begin))
+            self.transport.write(memoryview(piece)[begin: begin + length])
+            self.traffic.sent(length, 13)
+            await self.wire.drain()
+
+    def _message(self, msg_id, payload=b''):
+        # Everything built here gets written, so it is counted here
+        self.traffic.sent(0, 5 + len(payload))
+        return struct.pack('>IB', 1 + len(payload), msg_id) + payload
+
+    @property
+    def downloaded(self):
+        """Payload bytes received."""
+        return self.traffic.payload_down.total
+
+    @property
+    def uploaded(self):
+        """Payload bytes sent."""
+        return self.traffic.payload_up.total
+
+    @property
+    def download_rate(self):
+        """Payload bytes/sec received (smoothed, and decays while the peer sends nothing)."""
+        return self.traffic.payload_down.rate
 
     def close(self):
+        if self.closed:
+            return
         self.closed = True
-        if self.writer:
-            try:
-                self.writer.close()
-            except:
-                pass
\ No newline at end of file
+        if self._upload_task:
+            self._upload_task.cancel()
+        # Blocks we were waiting for go back to the shared pool
+        self._release_outstanding()
+        # This peer's pieces no longer count towards availability
+        self.piece_manager.remove_peer_pieces(
+            self, (i for i, has in enumerate(self.peer_pieces) if has)
+        )
+        if self.transport:
+            self.transport.close()
\ No newline at end of file
@@ -1,69 +1,415 @@
-import math
 import random
+from buffers import BufferPool
 from utils import Bitfield, logger
 
+BLOCK_SIZE = 16384  # 16KB, the de-facto request size every client accepts
+
+# Before we own a few complete pieces we have nothing to trade, so the
+# first pieces are picked at random (they finish faster than rare ones).
+RANDOM_FIRST_PIECES = 4
+
+# Endgame: a block is requested from at most this many peers at once
+MAX_BLOCK_REQUESTERS = 2
+
+
+class _PieceBucket:
+    """
+    A set of piece indices with O(1) add, remove and random access.
+    Removal swaps the last element into the hole, so order is arbitrary.
+    """
+    __slots__ = ("items", "positions")
+
+    def __init__(self):
+        self.items = []
+        self.positions = {}
+
+    def __len__(self):
+        return len(self.items)
+
+    def __contains__(self, index):
+        return index in self.positions
+
+    def add(self, index):
+        self.positions[index] = len(self.items)
+        self.items.append(index)
+
+    def remove(self, index):
+        pos = self.positions.pop(index)
+        last = self.items.pop()
+        if last != index:
+            self.items[pos] = last
+            self.positions[last] = pos
+
+    def sample_for(self, peer_pieces):
+        """Returns a random piece from this bucket that the peer has (or None)."""
+        count = len(self.items)
+        if count == 0:
+            return None
+        # Random starting point = random tie-breaking between equally rare pieces
+        start = random.randrange(count)
+        for offset in range(count):
+            index = self.items[(start + offset) % count]
+            if peer_pieces[index]:
+                return index
+        return None
+
+
+class PartialPiece:
+    """
+    A piece that is being downloaded, shared by every peer that has it.
+    Each block is either missing (nobody asked for it), requested (by one
+    or more peers) or received. Received blocks stay here when the peer
+    that sent them disconnects.
+
+    The whole piece is allocated up front and every block is copied
+    straight to its offset, so the finished buffer goes to the hasher and
+    the disk as it is (no joining).
+    """
+
+    def __init__(self, index, length, buffer=None):
+        self.index = index
+        self.length = length
+        self.block_count = (length + BLOCK_SIZE - 1) // BLOCK_SIZE
+        self.buffer = buffer if buffer is not None else bytearray(length)
+        self._view = memoryview(self.buffer)
+        self.received = bytearray(self.block_count)  # 1 per block we have
+        self.saved = bytearray(self.block_count)  # 1 per block fast-resume already wrote to disk
+        self.received_count = 0
+        self.bytes_received = 0
+        self.requested = {}  # begin -> set of peers we asked
+        self.timed_out = {}  # begin -> set of peers that sat on a request for it
+        # Popped from the end, so the lowest offsets go out first
+        self.missing = list(range((self.block_count - 1) * BLOCK_SIZE, -1, -BLOCK_SIZE))
+
+    def block_length(self, begin):
+        return min(BLOCK_SIZE, self.length - begin)
+
+    def valid_block(self, begin, length):
+        return begin % BLOCK_SIZE == 0 and begin < self.length and length == self.block_length(begin)
+
+    def has_block(self, begin):
+        return self.received[begin // BLOCK_SIZE]
+
+    def add_block(self, begin, data):
+        self._view[begin:begin + len(data)] = data
+        self.received[begin // BLOCK_SIZE] = 1
+        self.received_count += 1
+        self.bytes_received += len(data)
+
+    def received_blocks(self):
+        """(begin, view of the block) for every block we have."""
+        for i, have in enumerate(self.received):
+            if have:
+                begin = i * BLOCK_SIZE
+                yield begin, self._view[begin:begin + self.block_length(begin)]
+
+    @property
+    def is_complete(self):
+        return self.received_count == self.block_count
+
+    def data(self):
+        """The assembled piece. Not a copy: don't add blocks after this."""
+        return self.buffer
+
 
 class PieceManager:
-    def __init__(self, torrent):
+    def __init__(self, torrent, buffer_pool=None):
         self.torrent = torrent
+        # Piece buffers (shared memory budget when a Session passes one in)
+        self.buffers = buffer_pool or BufferPool()
         self.bitfield = Bitfield(torrent.number_of_pieces)
+        self.total_pieces = torrent.number_of_pieces
+        self.have_count = 0
+        self.bytes_completed = 0  # Verified payload
+        self.hash_failures = 0
+        self.request_timeouts = 0
+        self.wasted_bytes = 0  # Payload we got twice (endgame races) or couldn't use
+        self.cancels_sent = 0
 
-        # 1. Populate the list of needed pieces
-        self.missing_pieces = list(range(torrent.number_of_pieces))
+        # 1. Availability index: how many connected peers have each piece
+        self.availability = [0] * self.total_pieces
 
-        # 2. FIX: Randomize immediately!
-        # This prevents the "Piece 0, 1, 2" linear bottleneck.
-        random.shuffle(self.missing_pieces)
+        # 2. Pickable pieces (missing and not in flight), bucketed by availability.
+        # buckets[n] holds every pickable piece that exactly n peers have.
+        self.buckets = [_PieceBucket()]
+        for index in range(self.total_pieces):
+            self.buckets[0].add(index)
 
-        self.ongoing_pieces = []
-        self.total_pieces = torrent.number_of_pieces
+        # 3. Pieces in flight. 'open_pieces' are the ones with unrequested blocks.
+        self.partial_pieces = {}  # index -> PartialPiece
+        self.open_pieces = {}
+
+        # 4. How many pickable pieces each peer has. A peer with none skips
+        # the bucket scan in _pick_piece (which is O(pieces) when it finds nothing).
+        self.pickable_counts = {}  # peer -> count
+
+    # --- Availability tracking (fed by Have / Bitfield / disconnects) ---
+
+    def _bucket(self, count):
+        # Availability of in-flight / finished pieces can grow past the last bucket
+        while count >= len(self.buckets):
+            self.buckets.append(_PieceBucket())
+        return self.buckets[count]
+
+    def _move(self, index, old, new):
+        self._bucket(old).remove(index)
+        self._bucket(new).add(index)
+
+    def peer_has(self, peer, index):
+        """A peer announced a piece (Have message). peer.peer_pieces[index] is already set."""
+        old = self.availability[index]
+        self.availability[index] = old + 1
+        count = self.pickable_counts.get(peer, 0)
+        if index in self._bucket(old):
+            self._move(index, old, old + 1)
+            count += 1
+        self.pickable_counts[peer] = count
+
+    def add_peer_pieces(self, peer, indices):
+        """A peer sent its Bitfield. 'indices' are the pieces it has."""
+        for index in indices:
+            self.peer_has(peer, index)
+        self.pickable_counts.setdefault(peer, 0)
 
-    def get_next_piece_index(self):
+    def remove_peer_pieces(self, peer, indices):
+        """A peer disconnected. Its pieces no longer count towards availability."""
+        self.pickable_counts.pop(peer, None)
+        for index in indices:
+            old = self.availability[index]
+            if old == 0:
+                continue
+            self.availability[index] = old - 1
+            if index in self._bucket(old):
+                self._move(index, old, old - 1)
+
+    def _add_pickable(self, index):
+        self._bucket(self.availability[index]).add(index)
+        for peer in self.pickable_counts:
+            if peer.peer_pieces[index]:
+                self.pickable_counts[peer] += 1
+
+    def _remove_pickable(self, index, bucket):
+        bucket.remove(index)
+        for peer in self.pickable_counts:
+            if peer.peer_pieces[index]:
+                self.pickable_counts[peer] -= 1
+
+    # --- Picking ---
+
+    def _pick_piece(self, peer, peer_pieces):
         """
-        Retrieves the next piece index.
-        Note: The heavy lifting is done in peer.py which reads this list.
+        Picks the next piece to start from a peer.
+        Rarest-first, except for the first few pieces which are random.
+        Returns None if the peer has nothing we can start.
         """
-        # Prioritize missing pieces
-        if self.missing_pieces:
-            return self.missing_pieces[0]
-
-        # Endgame: If no missing pieces, return an ongoing one (Double Download)
-        if self.ongoing_pieces:
-            return random.choice(self.ongoing_pieces)
+        if not self.pickable_counts.get(peer):
+            return None
+        if self.have_count < RANDOM_FIRST_PIECES:
+            order = list(range(1, len(self.buckets)))
+            random.shuffle(order)
+        else:
+            order = range(1, len(self.buckets))
 
+        # Bucket 0 is skipped on purpose: nobody (including this peer) has those
+        for count in order:
+            bucket = self.buckets[count]
+            index = bucket.sample_for(peer_pieces)
+            if index is not None:
+                self._remove_pickable(index, bucket)
+                return index
         return None
 
+    def _take_blocks(self, piece, peer, count, blocks):
+        skipped = []
+        while piece.missing and len(blocks) < count:
+            begin = piece.missing.pop()
+            slow = piece.timed_out.get(begin)
+            # A block this peer timed out on goes to someone else, unless every
+            # peer that has the piece timed out on it too
+            if slow and peer in slow and len(slow) < self.availability[piece.index]:
+                skipped.append(begin)
+                continue
+            piece.requested[begin] = {peer}
+            blocks.append((piece.index, begin, piece.block_length(begin)))
+        piece.missing.extend(reversed(skipped))
+        if not piece.missing:
+            self.open_pieces.pop(piece.index, None)
+
+    def next_blocks(self, peer, peer_pieces, count):
+        """
+        Hands out up to 'count' blocks for a peer to request, as
+        (index, begin, length) tuples, and marks them requested by it.
+        """
+        blocks = []
+
+        # 1. Finish pieces that are already started (keeps partial pieces few)
+        for piece in list(self.open_pieces.values()):
+            if len(blocks) >= count:
+                return blocks
+            if peer_pieces[piece.index]:
+                self._take_blocks(piece, peer, count, blocks)
+
+        # 2. Start new pieces, rarest first. Not while the memory budget
+        # is used up: the pieces in flight have to finish first.
+        while len(blocks) < count and self.buffers.has_room(self.torrent.piece_length):
+            index = self._pick_piece(peer, peer_pieces)
+            if index is None:
+                break
+            size = self.torrent.piece_size(index)
+            piece = PartialPiece(index, size, self.buffers.acquire(size))
+            self.partial_pieces[index] = piece
+            self.open_pieces[index] = piece
+            self._take_blocks(piece, peer, count, blocks)
+
+        # 3. ENDGAME: nothing new left, so ask for blocks other peers are still
+        # sending. Whoever delivers first wins, the others get a cancel.
+        if len(blocks) < count and self.is_endgame:
+            for piece in self.partial_pieces.values():
+                if not peer_pieces[piece.index]:
+                    continue
+                for begin, peers in piece.requested.items():
+                    if peer not in peers and len(peers) < MAX_BLOCK_REQUESTERS:
+                        peers.add(peer)
+                        blocks.append((piece.index, begin, piece.block_length(begin)))
+                        if len(blocks) >= count:
+                            return blocks
+
+        return blocks
+
+    def release_blocks(self, peer, keys):
+        """
+        The peer will not send these (index, begin) blocks (choke, disconnect).
+        Blocks nobody else is fetching become missing again.
+        """
+        for index, begin in keys:
+            piece = self.partial_pieces.get(index)
+            if piece is None or begin not in piece.requested:
+                continue
+            peers = piece.requested[begin]
+            peers.discard(peer)
+            if not peers:
+                del piece.requested[begin]
+                piece.missing.append(begin)
+                self.open_pieces[index] = piece
+
+    def blocks_timed_out(self, peer, keys):
+        """
+        The peer didn't answer these requests in time. Other peers can fetch
+        the blocks now (the peer may still send them, see block_received).
+        """
+        self.request_timeouts += len(keys)
+        for index, begin in keys:
+            piece = self.partial_pieces.get(index)
+            if piece is not None and begin in piece.requested:
+                piece.timed_out.setdefault(begin, set()).add(peer)
+        self.release_blocks(peer, keys)
+
+    def block_received(self, peer, index, begin, data):
+        """
+        Stores a block. Returns the PartialPiece once all of its blocks are
+        in (ready for hash check), otherwise None.
+        """
+        piece = self.partial_pieces.get(index)
+        if piece is None or not piece.valid_block(begin, len(data)) or piece.has_block(begin):
+            self.wasted_bytes += len(data)
+            return None
+
+        piece.add_block(begin, data)  # The one copy: receive buffer -> piece buffer
+        peers = piece.requested.pop(begin, None)
+        if peers is None:
+            if begin in piece.missing:
+                # We had given up on this request, but the data came anyway
+                piece.missing.remove(begin)
+                if not piece.missing:
+                    self.open_pieces.pop(index, None)
+        else:
+            # Endgame duplicates: the others can stop sending it
+            for other in peers:
+                if other is not peer:
+                    other.cancel_block(index, begin, len(data))
+                    self.cancels_sent += 1
+        # Peers that timed out on it may still send it: take those requests back too
+        for other in piece.timed_out.pop(begin, ()):
+            if other is not peer and (peers is None or other not in peers):
+                other.cancel_block(index, begin, len(data))
+                self.cancels_sent += 1
+
+        return piece if piece.is_complete else None
+
+    def restore_partial(self, index, blocks):
+        """Puts back blocks saved by fast-resume. 'blocks' maps begin -> data."""
+        if self.bitfield.has_piece(index) or index in self.partial_pieces:
+            return
+        size = self.torrent.piece_size(index)
+        piece = PartialPiece(index, size, self.buffers.acquire(size))
+        for begin, data in blocks.items():
+            if begin in piece.missing and len(data) == piece.block_length(begin):
+                piece.add_block(begin, data)
+                piece.saved[begin // BLOCK_SIZE] = 1  # It came from the disk
+                piece.missing.remove(begin)
+        if not piece.received_count or piece.is_complete:
+            self.buffers.release(piece.buffer)
+            return  # A finished-but-unverified piece is simply fetched again
+
+        self._remove_pickable(index, self._bucket(self.availability[index]))
+        self.partial_pieces[index] = piece
+        if piece.missing:
+            self.open_pieces[index] = piece
+
     def mark_piece_complete(self, index):
-        if index in self.ongoing_pieces:
-            self.ongoing_pieces.remove(index)
+        if self.bitfield.has_piece(index):
+            return
 
-        if index in self.missing_pieces:
-            self.missing_pieces.remove(index)
+        # Its buffer is the disk writer's now (given back once written)
+        self.partial_pieces.pop(index, None)
+        self.open_pieces.pop(index, None)
+        bucket = self._bucket(self.availability[index])
+        if index in bucket:
+            self._remove_pickable(index, bucket)
 
         self.bitfield.set_piece(index)
+        self.have_count += 1
+        self.bytes_completed += self.torrent.piece_size(index)
         # We don't log every piece to save performance in high-speed mode
 
     def mark_piece_failed(self, index):
-        """If a piece fails hash check, put it back and SHUFFLE."""
-        if index in self.ongoing_pieces:
-            self.ongoing_pieces.remove(index)
+        """If a piece fails hash check, throw its blocks away and make it pickable again."""
+        self.hash_failures += 1
+        self.drop_piece(index)
 
-        if index not in self.missing_pieces:
-            self.missing_pieces.append(index)
-            # Shuffle again so we don't try the same failed piece immediately
-            random.shuffle(self.missing_pieces)
+    def drop_piece(self, index):
+        """Throws an in-flight piece away (its buffer goes back) and makes it pickable again."""
+        piece = self.partial_pieces.pop(index, None)
+        if piece is None:
+            return
+        self.buffers.release(piece.buffer)
+        self.open_pieces.pop(index, None)
+        self._add_pickable(index)
+
+    def close(self):
+        """
+        Gives the buffers of unfinished pieces back (the torrent stopped) and
+        makes those pieces pickable again. Finished ones are still with the
+        hasher, which gives them back.
+        """
+        for index, piece in list(self.partial_pieces.items()):
+            if not piece.is_complete:
+                self.drop_piece(index)
+
+    @property
+    def missing_count(self):
+        return self.total_pieces - self.have_count
 
     @property
     def complete(self):
-        return len(self.missing_pieces) == 0 and len(self.ongoing_pieces) == 0
+        return self.have_count == self.total_pieces
 
     @property
     def is_endgame(self):
         """
-        Returns True if we are in the last 5% of the download.
-        This tells peers to start 'Racing' (Double Downloading).
+        True once every missing piece that a connected peer has is in flight,
+        with all of its blocks requested. From then on idle peers ask for
+        blocks that are already requested from someone else (at most
+        MAX_BLOCK_REQUESTERS per block), so one slow peer can't hold up the end.
         """
-        remaining = len(self.missing_pieces)
-        total = self.total_pieces
-        # Trigger endgame if less than 5% left or less than 20 pieces total
-        return (remaining < 20) or (remaining / total < 0.05)
\ No newline at end of file
+        return bool(self.partial_pieces) and not self.open_pieces and not any(self.buckets[1:])
@@ -0,0 +1,168 @@
+import asyncio
+import os
+from bencoding import Decoder, Encoder
+from piece_manager import BLOCK_SIZE
+from utils import logger
+
+# Pieces being read + hashed at the same time during a full recheck
+RECHECK_WINDOW = 32
+
+
+class FastResume:
+    """
+    Saves download progress next to the data so a restart does not fetch
+    everything again.
+
+    The resume file is a bencoded dict with our bitfield, the size and mtime
+    of every file, and the received blocks of unfinished pieces (the block
+    data itself is written into the files, only the offsets are stored).
+    On startup the file is trusted only if the file metadata still matches.
+    Otherwise every piece already on disk is re-hashed in parallel.
+    """
+
+    def __init__(self, torrent, piece_manager, file_handler, hash_pool, save_path):
+        self.torrent = torrent
+        self.piece_manager = piece_manager
+        self.file_handler = file_handler
+        self.hash_pool = hash_pool
+        self.path = os.path.join(save_path, f".{torrent.info_hash.hex()}.fastresume")
+
+    # --- Saving ---
+
+    def snapshot(self):
+        """
+        Captures the state to save. Must run on the event loop thread.
+        Partial blocks not written by an earlier save are queued for
+        writing here, so flush() before save().
+        """
+        partial = {}
+        for index, piece in self.piece_manager.partial_pieces.items():
+            if not piece.received_count:
+                continue
+            begins = []
+            for begin, block in piece.received_blocks():
+                if not piece.saved[begin // BLOCK_SIZE]:
+                    # A copy: the piece buffer is reused once the piece is done
+                    self.file_handler.write_block(index, begin, bytes(block))
+                    piece.saved[begin // BLOCK_SIZE] = 1
+                begins.append(begin)
+            partial[str(index)] = begins
+
+        return {
+            "info-hash": self.torrent.info_hash,
+            "bitfield": bytes(self.piece_manager.bitfield.field),
+            "partial": partial,
+        }
+
+    def save(self, state):
+        """Flushes the data files and writes the resume file. Blocking (run it in a thread)."""
+        self.file_handler.flush()
+        if self.file_handler.error is not None:
+            raise self.file_handler.error  # Pieces in 'state' may not be on disk
+        state = dict(state)
+        state["files"] = [[size, mtime] for size, mtime in self.file_handler.file_stats()]
+
+        # Write to a temp file first so a crash never leaves half a resume file
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(Encoder.encode(state))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+    async def save_async(self):
+        """Saves from the event loop. Returns the saved state."""
+        state = self.snapshot()
+        await asyncio.to_thread(self.save, state)
+        return state
+
+    # --- Loading ---
+
+    async def restore(self):
+        """Restores progress from the resume file, or rechecks the files. Returns pieces restored."""
+        state = self._load()
+        if state is not None:
+            restored = self._apply(state)
+            logger.info(f"Fast-resume: {restored} pieces restored")
+            return restored
+
+        if not self.file_handler.has_existing_data:
+            return 0
+
+        logger.info("Fast-resume data missing or stale, rechecking files...")
+        restored = await self.recheck()
+        logger.info(f"Recheck: {restored}/{self.torrent.number_of_pieces} pieces valid")
+        return restored
+
+    def _load(self):
+        try:
+            with open(self.path, "rb") as f:
+                state = Decoder(f.read()).decode()
+        except (OSError, ValueError, IndexError):
+            return None
+
+        if not isinstance(state, dict) or state.get("info-hash") != self.torrent.info_hash:
+            return None
+
+        # Any change to the files since the save (crash mid-download, user edits)
+        # means the bitfield can't be trusted.
+        saved_files = [tuple(entry) for entry in state.get("files", [])]
+        if saved_files != self.file_handler.file_stats():
+            return None
+
+        if len(state.get("bitfield", b"")) != len(self.piece_manager.bitfield.field):
+            return None
+        return state
+
+    def _apply(self, state):
+        bitfield = state["bitfield"]
+        restored = 0
+        for index in range(self.torrent.number_of_pieces):
+            if (bitfield[index >> 3] >> (7 - (index & 7))) & 1:
+                self.piece_manager.mark_piece_complete(index)
+                restored += 1
+
+        self.restore_partial(state.get("partial", {}))
+        return restored
+
+    def restore_partial(self, partial):
+        """Reads the saved blocks of unfinished pieces ('partial' of a saved state) back in."""
+        for key, begins in partial.items():
+            index = int(key)
+            if index >= self.torrent.number_of_pieces:
+                continue
+            piece_size = self.torrent.piece_size(index)
+            blocks = {}
+            for begin in begins:
+                length = min(BLOCK_SIZE, piece_size - begin)
+                blocks[begin] = self.file_handler.read(index, begin, length)
+            self.piece_manager.restore_partial(index, blocks)
+
+    async def recheck(self):
+        """Hashes every piece on disk, using all hash workers at once."""
+        async def check(index):
+            data = await asyncio.to_thread(self.file_handler.read, index)
+            job = await self.hash_pool.submit(data)
+            return index, await job
+
+        restored = 0
+        pending = set()
+        for index in range(self.torrent.number_of_pieces):
+            if len(pending) >= RECHECK_WINDOW:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                restored += self._apply_checked(done)
+            pending.add(asyncio.ensure_future(check(index)))
+
+        if pending:
+            done, _ = await asyncio.wait(pending)
+            restored += self._apply_checked(done)
+        return restored
+
+    def _apply_checked(self, done):
+        valid = 0
+        for task in done:
+            index, digest = task.result()
+            if digest == self.torrent.pieces_hashes[index]:
+                self.piece_manager.mark_piece_complete(index)
+                valid += 1
+        return valid
@@ -0,0 +1,289 @@
+import asyncio
+import time
+from types import MappingProxyType
+from client import TorrentClient, MAX_ACTIVE_PEERS, STATS_INTERVAL
+from dialer import Dialer, MAX_HALF_OPEN
+from file_handler import DiskPool
+from buffers import BufferPool, MEMORY_BUDGET
+from listener import PeerListener, LISTEN_PORT
+from hasher import HashPool
+from udp_tracker import UDPTrackerClient
+from tracker import UDP_MAX_RETRIES
+from bandwidth import global_limiter
+from stats import session_traffic
+from utils import logger
+
+MAX_ACTIVE = 3  # Torrents downloading at once, the rest wait in the queue
+MAX_CONNECTIONS = 500  # Peer connections across all torrents
+MIN_PEERS_PER_TORRENT = 10  # Floor of a torrent's share (if the cap allows)
+DISK_WORKERS = 2
+SCHEDULE_INTERVAL = 2  # seconds
+REQUEUE_DELAY = 60  # A torrent that stopped without finishing (crashed) waits this long
+
+# Session-side states (TorrentClient.stats() adds 'downloading', 'seeding', ...)
+QUEUED = "queued"
+PAUSED = "paused"
+
+
+class Session:
+    """
+    Runs many torrents on one event loop.
+    Every torrent shares one hash pool, one set of disk writer threads, one
+    UDP tracker socket, one dialer (half-open limit), one listening port and
+    one memory budget for piece data. At most 'max_active'
+    torrents download at once; the others wait in the queue, in the order
+    they were added. 'max_connections' is split between the running torrents,
+    and a torrent that can't use its share (few peers known) leaves it to
+    the others. Finished torrents that seed don't take a download slot.
+    """
+
+    def __init__(self, save_path=".", max_active=MAX_ACTIVE, max_connections=MAX_CONNECTIONS,
+                 hash_workers=None, hash_processes=False, disk_workers=DISK_WORKERS,
+                 max_half_open=MAX_HALF_OPEN, download_limit=0, upload_limit=0, stats_queue=None,
+                 listen_port=LISTEN_PORT, memory_budget=MEMORY_BUDGET):
+        self.save_path = save_path
+        self.max_active = max_active
+        self.max_connections = max_connections
+        self.stats_queue = stats_queue  # Read-only stats() snapshots for other threads
+
+        # Shared by every torrent
+        self.hash_pool = HashPool(workers=hash_workers, use_processes=hash_processes)
+        self.disk_pool = DiskPool(workers=disk_workers)
+        self.udp_client = UDPTrackerClient(max_retries=UDP_MAX_RETRIES)
+        self.dialer = Dialer(max_half_open=max_half_open)
+        self.listener = PeerListener(port=listen_port, max_connections=max_connections)
+        self.buffer_pool = BufferPool(memory_budget)
+        global_limiter.set_limits(download_limit, upload_limit)
+
+        self.torrents = {}  # info_hash -> TorrentClient, in queue order
+        self._tasks = {}  # info_hash -> task running TorrentClient.start()
+        self._paused = set()
+        self._retry_at = {}  # info_hash -> time it may be started again
+        self._wakeup = asyncio.Event()
+        self._closed = False
+        self.loop = None  # Set by run()
+
+    # --- Torrents ---
+
+    def add(self, torrent_file, save_path=None, seed=False, paused=False):
+        """Adds a torrent to the end of the queue. Returns its TorrentClient."""
+        client = TorrentClient(
+            torrent_file, save_path or self.save_path, seed=seed,
+            hash_pool=self.hash_pool, udp_client=self.udp_client,
+            dialer=self.dialer, disk_pool=self.disk_pool, listener=self.listener,
+            buffer_pool=self.buffer_pool,
+        )
+        info_hash = client.torrent.info_hash
+        if info_hash in self.torrents:
+            client.file_handler.close()
+            return self.torrents[info_hash]
+
+        self.torrents[info_hash] = client
+        if paused:
+            self._paused.add(info_hash)
+        self._wakeup.set()
+        return client
+
+    async def remove(self, info_hash):
+        """Stops a torrent and forgets it. The downloaded data stays on disk."""
+        info_hash = _key(info_hash)
+        client = self.torrents.get(info_hash)
+        if client is None:
+            return
+        await self._stop(info_hash)
+        del self.torrents[info_hash]
+        self._paused.discard(info_hash)
+        self._retry_at.pop(info_hash, None)
+        client.piece_manager.close()
+        await asyncio.to_thread(client.file_handler.close)
+
+    async def pause(self, info_hash):
+        """Disconnects a torrent (resume data is saved) and frees its slot."""
+        info_hash = _key(info_hash)
+        if info_hash in self.torrents:
+            self._paused.add(info_hash)
+            await self._stop(info_hash)
+            self._wakeup.set()
+
+    def resume(self, info_hash):
+        """Puts a paused torrent back in the queue (keeping its place)."""
+        info_hash = _key(info_hash)
+        self._paused.discard(info_hash)
+        self._retry_at.pop(info_hash, None)
+        self._wakeup.set()
+
+    def set_limits(self, download_limit=None, upload_limit=None):
+        """Process-wide rate limits (bytes/sec, 0 = unlimited)."""
+        global_limiter.set_limits(download_limit, upload_limit)
+
+    def state(self, info_hash):
+        info_hash = _key(info_hash)
+        if info_hash in self._paused:
+            return PAUSED
+        if info_hash in self._tasks or self.torrents[info_hash].file_handler.error is not None:
+            return self.torrents[info_hash].stats()["state"]
+        if self.torrents[info_hash].piece_manager.complete:
+            return "complete"
+        return QUEUED
+
+    # --- Running ---
+
+    async def run(self):
+        """Scheduler loop. Runs until close()."""
+        self.loop = asyncio.get_running_loop()
+        try:
+            await self.listener.start()
+        except OSError as e:
+            logger.warning(f"Could not listen on port {self.listener.port}: {e}")
+        publisher = asyncio.create_task(self._publish_stats()) if self.stats_queue else None
+        try:
+            while not self._closed:
+                self._schedule()
+                self._rebalance()
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=SCHEDULE_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            if publisher:
+                publisher.cancel()
+
+    def run_threadsafe(self, func, *args):
+        """Calls func(*args) on the session's loop (coroutine functions become tasks)."""
+        def call():
+            result = func(*args)
+            if asyncio.iscoroutine(result):
+                asyncio.ensure_future(result)
+        self.loop.call_soon_threadsafe(call)
+
+    async def close(self):
+        """Stops every torrent (saving resume data) and shuts the shared pools down."""
+        self._closed = True
+        self._wakeup.set()
+        await asyncio.gather(*(self._stop(h) for h in list(self._tasks)))
+        for client in self.torrents.values():
+            await asyncio.to_thread(client.file_handler.close)
+        await self.listener.close()
+        self.hash_pool.close()
+        self.udp_client.close()
+        await asyncio.to_thread(self.disk_pool.close)
+
+    async def wait_finished(self):
+        """
+        Returns once every torrent is complete and done announcing it.
+        Never returns while a torrent seeds (or is paused).
+        """
+        while True:
+            finished = all(
+                c.piece_manager.complete and not c.seed and h not in self._paused
+                and (h not in self._tasks or self._tasks[h].done())
+                for h, c in self.torrents.items()
+            )
+            if finished:
+                return
+            await asyncio.sleep(1)
+
+    def downloading(self):
+        """Info-hashes of the running torrents that are still downloading."""
+        return [h for h in self._tasks if not self.torrents[h].piece_manager.complete]
+
+    def _schedule(self):
+        now = time.time()
+
+        # Reap torrents whose run ended (finished or crashed)
+        for info_hash, task in list(self._tasks.items()):
+            if not task.done():
+                continue
+            del self._tasks[info_hash]
+            if not task.cancelled() and task.exception() is not None:
+                logger.error(f"Torrent {info_hash.hex()} failed: {task.exception()!r}")
+            if not self.torrents[info_hash].piece_manager.complete:
+                # Back of the queue, and not straight away
+                self.torrents[info_hash] = self.torrents.pop(info_hash)
+                self._retry_at[info_hash] = now + REQUEUE_DELAY
+
+        # Start queued torrents, oldest first
+        free = self.max_active - len(self.downloading())
+        for info_hash, client in self.torrents.items():
+            if free <= 0:
+                break
+            if info_hash in self._tasks or info_hash in self._paused:
+                continue
+            if client.piece_manager.complete and not client.seed:
+                continue
+            if client.file_handler.error is not None:
+                continue  # Disk failure: stays stopped until removed
+            if self._retry_at.get(info_hash, 0) > now:
+                continue
+            self._retry_at.pop(info_hash, None)
+            self._tasks[info_hash] = asyncio.create_task(client.start())
+            if not client.piece_manager.complete:
+                free -= 1
+
+    def _rebalance(self):
+        """
+        Splits 'max_connections' between the running torrents.
+        Torrents that know of fewer peers than a fair share keep only what
+        they can use; what is left is shared by the rest (water-filling).
+        """
+        running = [self.torrents[h] for h in self._tasks]
+        if not running:
+            return
+
+        demand = {c: len(c.peers) + c.candidates.ready_count for c in running}
+        budget = self.max_connections
+        remaining = sorted(running, key=demand.get)
+        while remaining:
+            client = remaining.pop(0)
+            share = budget // (len(remaining) + 1)
+            floor = min(share, MIN_PEERS_PER_TORRENT)
+            client.max_peers = max(floor, min(MAX_ACTIVE_PEERS, demand[client], share))
+            budget -= client.max_peers
+
+    async def _stop(self, info_hash):
+        task = self._tasks.pop(info_hash, None)
+        if task is None:
+            return
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            logger.error(f"Torrent {info_hash.hex()} failed while stopping: {e!r}")
+
+    # --- Stats ---
+
+    def stats(self):
+        torrents = []
+        for info_hash, client in self.torrents.items():
+            stats = client.stats()
+            if info_hash not in self._tasks:
+                stats["state"] = self.state(info_hash)
+            torrents.append(MappingProxyType(stats))
+
+        stats = session_traffic.snapshot()
+        stats.update({
+            "torrents": tuple(torrents),
+            "active": len(self.downloading()),
+            "queued": sum(1 for t in torrents if t["state"] == QUEUED),
+            "connections": sum(len(c.peers) for c in self.torrents.values()),
+            "hash_queue": self.hash_pool.pending,
+            "memory_used": self.buffer_pool.used,
+            "memory_budget": self.buffer_pool.budget,
+            "connect_success_rate": self.dialer.success_rate,
+            "listen_port": self.listener.port,
+            "incoming_accepted": self.listener.accepted,
+            "incoming_rejected": self.listener.rejected,
+        })
+        return stats
+
+    async def _publish_stats(self):
+        while True:
+            self.stats_queue.put(MappingProxyType(self.stats()))
+            await asyncio.sleep(STATS_INTERVAL)
+
+
+def _key(info_hash):
+    return bytes.fromhex(info_hash) if isinstance(info_hash, str) else info_hash
@@ -0,0 +1,87 @@
+import time
+
+RATE_WINDOW = 1.0  # seconds per rate sample
+RATE_ALPHA = 0.3  # EWMA weight of the newest sample
+
+
+class RateCounter:
+    """
+    A byte total plus its smoothed rate (bytes/sec).
+    Samples are taken once per RATE_WINDOW, lazily, when bytes are added
+    or the rate is read, so an idle counter still decays towards zero.
+    """
+    __slots__ = ("total", "_rate", "_window_start", "_window_bytes")
+
+    def __init__(self):
+        self.total = 0
+        self._rate = 0.0
+        self._window_start = time.monotonic()
+        self._window_bytes = 0
+
+    def add(self, amount):
+        self.total += amount
+        self._window_bytes += amount
+        self._tick(time.monotonic())
+
+    @property
+    def rate(self):
+        self._tick(time.monotonic())
+        return self._rate
+
+    def _tick(self, now):
+        elapsed = now - self._window_start
+        if elapsed < RATE_WINDOW:
+            return
+        sample = self._window_bytes / elapsed
+        # A long idle gap counts as several empty windows
+        decay = (1 - RATE_ALPHA) ** min(int(elapsed / RATE_WINDOW), 50)
+        self._rate = self._rate * decay + sample * (1 - decay)
+        self._window_bytes = 0
+        self._window_start = now
+
+
+class TrafficCounters:
+    """
+    Payload and protocol overhead, both directions, for one scope: a peer,
+    a torrent or the whole process. Every count is also added to the
+    parent, so the torrent and session totals are always current.
+    """
+
+    def __init__(self, parent=None):
+        self.parent = parent
+        self.payload_down = RateCounter()
+        self.payload_up = RateCounter()
+        self.overhead_down = RateCounter()
+        self.overhead_up = RateCounter()
+
+    def received(self, payload, overhead=0):
+        if payload:
+            self.payload_down.add(payload)
+        if overhead:
+            self.overhead_down.add(overhead)
+        if self.parent:
+            self.parent.received(payload, overhead)
+
+    def sent(self, payload, overhead=0):
+        if payload:
+            self.payload_up.add(payload)
+        if overhead:
+            self.overhead_up.add(overhead)
+        if self.parent:
+            self.parent.sent(payload, overhead)
+
+    def snapshot(self):
+        return {
+            "downloaded": self.payload_down.total,
+            "uploaded": self.payload_up.total,
+            "overhead_down": self.overhead_down.total,
+            "overhead_up": self.overhead_up.total,
+            "download_rate": self.payload_down.rate,
+            "upload_rate": self.payload_up.rate,
+            "overhead_down_rate": self.overhead_down.rate,
+            "overhead_up_rate": self.overhead_up.rate,
+        }
+
+
+# Process-wide totals, every torrent's counters chain up to this
+session_traffic = TrafficCounters()
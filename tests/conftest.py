@@ -0,0 +1,32 @@
+import hashlib
+import os
+import sys
+
+import pytest
+
+# The modules live flat in the repo root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bencoding import Encoder  # noqa: E402
+
+
+@pytest.fixture
+def make_torrent(tmp_path):
+    """
+    Writes a .torrent for random data and returns (path, data).
+    'files' splits the data into a multi-file torrent (list of lengths).
+    """
+    def make(size=5 * 32768 + 1000, piece_length=32768, files=None):
+        data = os.urandom(size)
+        pieces = b"".join(
+            hashlib.sha1(data[i:i + piece_length]).digest() for i in range(0, size, piece_length)
+        )
+        info = {"name": "payload", "piece length": piece_length, "pieces": pieces}
+        if files:
+            info["files"] = [{"length": length, "path": [f"f{i}.bin"]} for i, length in enumerate(files)]
+        else:
+            info["length"] = size
+        path = tmp_path / "test.torrent"
+        path.write_bytes(Encoder.encode({"announce": "http://127.0.0.1:1/announce", "info": info}))
+        return str(path), data
+    return make
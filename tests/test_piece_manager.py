@@ -0,0 +1,190 @@
+from buffers import BufferPool
+from piece_manager import PieceManager, BLOCK_SIZE, RANDOM_FIRST_PIECES
+
+
+class FakeTorrent:
+    def __init__(self, pieces, piece_length=2 * BLOCK_SIZE):
+        self.number_of_pieces = pieces
+        self.piece_length = piece_length
+        self.total_length = pieces * piece_length
+
+    def piece_size(self, index):
+        return self.piece_length
+
+
+class FakePeer:
+    def __init__(self, pm, pieces):
+        self.peer_pieces = [False] * pm.total_pieces
+        self.cancelled = []
+        for index in pieces:
+            self.peer_pieces[index] = True
+        pm.add_peer_pieces(self, pieces)
+
+    def cancel_block(self, index, begin, length):
+        self.cancelled.append((index, begin))
+
+
+def receive(pm, peer, blocks):
+    """Delivers blocks. Returns the pieces that completed."""
+    done = []
+    for index, begin, length in blocks:
+        piece = pm.block_received(peer, index, begin, bytes(length))
+        if piece is not None:
+            done.append(piece.index)
+    return done
+
+
+def finish_pieces(pm, indices):
+    # Past the random-first phase
+    for index in indices:
+        pm.mark_piece_complete(index)
+
+
+def test_rarest_piece_first():
+    pm = PieceManager(FakeTorrent(10))
+    finish_pieces(pm, range(RANDOM_FIRST_PIECES))
+    common = [FakePeer(pm, range(10)) for _ in range(3)]
+    FakePeer(pm, [4, 5, 6, 7, 8])
+    FakePeer(pm, [7, 8])
+
+    # 9 is on 3 peers, 4-6 on 4, 7-8 on 5: 9 first, then 4-6
+    blocks = pm.next_blocks(common[0], common[0].peer_pieces, 2)
+    assert {index for index, _, _ in blocks} == {9}
+    blocks = pm.next_blocks(common[0], common[0].peer_pieces, 6)
+    assert {index for index, _, _ in blocks} == {4, 5, 6}
+
+
+def test_started_pieces_are_finished_first():
+    pm = PieceManager(FakeTorrent(10))
+    a = FakePeer(pm, range(10))
+    b = FakePeer(pm, range(10))
+    first = pm.next_blocks(a, a.peer_pieces, 1)
+    second = pm.next_blocks(b, b.peer_pieces, 1)
+    assert first[0][0] == second[0][0]
+    assert first[0][1] != second[0][1]
+
+
+def test_peer_without_needed_pieces_gets_nothing():
+    pm = PieceManager(FakeTorrent(10))
+    finish_pieces(pm, [0, 1])
+    peer = FakePeer(pm, [0, 1])
+    assert pm.pickable_counts[peer] == 0
+    assert pm.next_blocks(peer, peer.peer_pieces, 10) == []
+
+    # A Have for a piece we still need makes it interesting again
+    peer.peer_pieces[5] = True
+    pm.peer_has(peer, 5)
+    assert [index for index, _, _ in pm.next_blocks(peer, peer.peer_pieces, 10)] == [5, 5]
+
+
+def test_pickable_counts_follow_picks_and_failures():
+    pm = PieceManager(FakeTorrent(4))
+    a = FakePeer(pm, range(4))
+    b = FakePeer(pm, [0, 1])
+    blocks = pm.next_blocks(a, a.peer_pieces, 8)
+    assert pm.pickable_counts == {a: 0, b: 0}
+
+    # A piece that fails its hash check can be picked again
+    index = blocks[0][0]
+    assert receive(pm, a, [blk for blk in blocks if blk[0] == index]) == [index]
+    pm.mark_piece_failed(index)
+    assert pm.pickable_counts[a] == 1
+    assert pm.pickable_counts[b] == (1 if index < 2 else 0)
+    assert pm.hash_failures == 1
+
+
+def test_blocks_of_a_disconnected_peer_are_handed_out_again():
+    pm = PieceManager(FakeTorrent(2))
+    a = FakePeer(pm, [0, 1])
+    b = FakePeer(pm, [0, 1])
+    blocks = pm.next_blocks(a, a.peer_pieces, 2)
+
+    # Started pieces come first, so b gets exactly what a gave back
+    pm.release_blocks(a, [(index, begin) for index, begin, _ in blocks])
+    assert sorted(pm.next_blocks(b, b.peer_pieces, 2)) == sorted(blocks)
+
+
+def test_timed_out_blocks_go_to_other_peers():
+    pm = PieceManager(FakeTorrent(2))
+    slow = FakePeer(pm, [0, 1])
+    fast = FakePeer(pm, [0, 1])
+    blocks = pm.next_blocks(slow, slow.peer_pieces, 1)
+    index, begin, _ = blocks[0]
+    pm.blocks_timed_out(slow, [(index, begin)])
+
+    # The slow peer refills its pipeline with something else
+    assert blocks[0] not in pm.next_blocks(slow, slow.peer_pieces, 1)
+    assert pm.next_blocks(fast, fast.peer_pieces, 1) == blocks
+
+    # The fast peer delivers: the late request of the slow one is cancelled
+    receive(pm, fast, blocks)
+    assert slow.cancelled == [(index, begin)]
+
+
+def test_timed_out_block_with_a_single_source_is_requested_again():
+    pm = PieceManager(FakeTorrent(1))
+    slow = FakePeer(pm, [0])
+    blocks = pm.next_blocks(slow, slow.peer_pieces, 1)
+    pm.blocks_timed_out(slow, [(index, begin) for index, begin, _ in blocks])
+    assert blocks[0] in pm.next_blocks(slow, slow.peer_pieces, 2)
+
+
+def test_endgame_duplicates_and_cancels():
+    pm = PieceManager(FakeTorrent(2))
+    slow = FakePeer(pm, [0, 1])
+    fast = FakePeer(pm, [0, 1])
+    third = FakePeer(pm, [0, 1])
+    blocks = pm.next_blocks(slow, slow.peer_pieces, 4)
+    assert len(blocks) == 4
+    assert pm.is_endgame
+
+    # Everything is requested: the idle peer asks for the same blocks
+    duplicates = pm.next_blocks(fast, fast.peer_pieces, 10)
+    assert sorted(duplicates) == sorted(blocks)
+    # At most MAX_BLOCK_REQUESTERS (2) peers per block
+    assert pm.next_blocks(third, third.peer_pieces, 10) == []
+
+    # The fast peer delivers first, the slow one gets cancels
+    assert sorted(receive(pm, fast, duplicates)) == [0, 1]
+    assert sorted(slow.cancelled) == sorted((index, begin) for index, begin, _ in blocks)
+    assert pm.cancels_sent == 4
+
+    # The slow peer's copies arrive anyway: wasted
+    receive(pm, slow, blocks[:1])
+    assert pm.wasted_bytes == BLOCK_SIZE
+
+
+def test_no_new_pieces_over_the_memory_budget():
+    pool = BufferPool(budget=2 * BLOCK_SIZE)
+    pm = PieceManager(FakeTorrent(4), buffer_pool=pool)
+    peer = FakePeer(pm, range(4))
+
+    # One piece fits the budget, the next has to wait for it
+    blocks = pm.next_blocks(peer, peer.peer_pieces, 8)
+    assert {index for index, _, _ in blocks} == {blocks[0][0]}
+    assert pool.used == 2 * BLOCK_SIZE
+
+    index = blocks[0][0]
+    receive(pm, peer, blocks)
+    pm.mark_piece_failed(index)
+    assert pool.used == 0
+    assert pm.next_blocks(peer, peer.peer_pieces, 2)
+
+
+def test_a_stopped_torrent_leaves_the_memory_budget_to_others():
+    pool = BufferPool(budget=2 * BLOCK_SIZE)
+    stopped = PieceManager(FakeTorrent(4), buffer_pool=pool)
+    running = PieceManager(FakeTorrent(4), buffer_pool=pool)
+    peer = FakePeer(stopped, range(4))
+    other = FakePeer(running, range(4))
+    blocks = stopped.next_blocks(peer, peer.peer_pieces, 1)
+    receive(stopped, peer, blocks)
+    assert running.next_blocks(other, other.peer_pieces, 2) == []
+
+    stopped.remove_peer_pieces(peer, range(4))
+    stopped.close()
+    assert pool.used == 0 and not stopped.partial_pieces
+    assert running.next_blocks(other, other.peer_pieces, 2)
+    # The piece can be started again after a restart
+    peer = FakePeer(stopped, range(4))
+    assert stopped.pickable_counts[peer] == 4
@@ -0,0 +1,98 @@
+import asyncio
+import os
+
+from file_handler import FileHandler
+from hasher import HashPool
+from piece_manager import PieceManager, BLOCK_SIZE
+from resume import FastResume
+from torrent import Torrent
+
+
+class FakePeer:
+    def __init__(self, pm, pieces):
+        self.peer_pieces = [i in pieces for i in range(pm.total_pieces)]
+        pm.add_peer_pieces(self, pieces)
+
+    def cancel_block(self, index, begin, length):
+        pass
+
+
+def open_torrent(path, save_path):
+    torrent = Torrent(path)
+    file_handler = FileHandler(torrent, save_path)
+    piece_manager = PieceManager(torrent)
+    fast_resume = FastResume(torrent, piece_manager, file_handler, HashPool(workers=2), save_path)
+    return torrent, piece_manager, file_handler, fast_resume
+
+
+def piece_data(torrent, data, index):
+    start = index * torrent.piece_length
+    return data[start:start + torrent.piece_size(index)]
+
+
+def download(path, save_path, data, pieces, partial_piece):
+    """Completes 'pieces', gets the first block of 'partial_piece', saves and closes."""
+    async def main():
+        torrent, pm, fh, fast_resume = open_torrent(path, save_path)
+        for index in pieces:
+            fh.write(index, piece_data(torrent, data, index))
+            pm.mark_piece_complete(index)
+
+        peer = FakePeer(pm, [partial_piece])
+        index, begin, length = pm.next_blocks(peer, peer.peer_pieces, 1)[0]
+        pm.block_received(peer, index, begin, piece_data(torrent, data, index)[begin:begin + length])
+
+        await fast_resume.save_async()
+        fh.close()
+        fast_resume.hash_pool.close()
+    asyncio.run(main())
+
+
+def restore(path, save_path):
+    async def main():
+        torrent, pm, fh, fast_resume = open_torrent(path, save_path)
+        try:
+            return await fast_resume.restore(), pm
+        finally:
+            fh.close()
+            fast_resume.hash_pool.close()
+    return asyncio.run(main())
+
+
+def test_restore_from_resume_file(make_torrent, tmp_path):
+    path, data = make_torrent(files=[50000, 50000, 64840])
+    download(path, str(tmp_path), data, [0, 2, 5], partial_piece=1)
+
+    restored, pm = restore(path, str(tmp_path))
+    assert restored == 3
+    assert [pm.bitfield.has_piece(i) for i in range(pm.total_pieces)] == \
+        [True, False, True, False, False, True]
+    assert pm.bytes_completed == 2 * 32768 + 1000
+
+    # The block we had of piece 1 is back, the rest is still to fetch
+    piece = pm.partial_pieces[1]
+    assert piece.received_count == 1
+    assert bytes(piece.buffer[:BLOCK_SIZE]) == data[32768:32768 + BLOCK_SIZE]
+    assert piece.saved[0] and piece.missing == [BLOCK_SIZE]
+
+
+def test_changed_files_are_rechecked(make_torrent, tmp_path):
+    path, data = make_torrent()
+    download(path, str(tmp_path), data, [0, 2, 5], partial_piece=1)
+
+    # Someone touched the data: the resume file can't be trusted any more
+    with open(os.path.join(str(tmp_path), "payload", "payload"), "r+b") as f:
+        f.seek(2 * 32768 + 10)
+        f.write(b"corrupt")
+
+    restored, pm = restore(path, str(tmp_path))
+    assert restored == 2
+    assert pm.bitfield.has_piece(0) and pm.bitfield.has_piece(5)
+    assert not pm.bitfield.has_piece(2)
+    assert not pm.partial_pieces  # Only verified pieces survive a recheck
+
+
+def test_nothing_on_disk(make_torrent, tmp_path):
+    path, _ = make_torrent()
+    restored, pm = restore(path, str(tmp_path))
+    assert restored == 0 and pm.have_count == 0
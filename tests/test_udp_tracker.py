@@ -0,0 +1,128 @@
+import asyncio
+import struct
+
+import pytest
+
+from udp_tracker import (
+    UDPTrackerClient, UDPTrackerError, PROTOCOL_ID, MAX_SCRAPE_HASHES,
+    ACTION_CONNECT, ACTION_ANNOUNCE, ACTION_SCRAPE, ACTION_ERROR,
+)
+
+CONNECTION_ID = 0x1122334455667788
+PEERS = bytes([10, 0, 0, 1]) + struct.pack(">H", 6881) + bytes([10, 0, 0, 2]) + struct.pack(">H", 51413)
+
+
+class StubTracker(asyncio.DatagramProtocol):
+    """A BEP 15 tracker on localhost. 'drop' = how many announces to ignore first."""
+
+    def __init__(self, drop=0, error=None):
+        self.drop = drop
+        self.error = error
+        self.connects = 0
+        self.announces = []  # Raw announce packets that were answered
+        self.scrapes = []  # Info-hashes per scrape packet
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        connection_id, action, tid = struct.unpack(">QII", data[:16])
+        if action == ACTION_CONNECT:
+            assert connection_id == PROTOCOL_ID
+            self.connects += 1
+            self.transport.sendto(struct.pack(">IIQ", ACTION_CONNECT, tid, CONNECTION_ID), addr)
+            return
+
+        assert connection_id == CONNECTION_ID
+        if self.error:
+            self.transport.sendto(struct.pack(">II", ACTION_ERROR, tid) + self.error, addr)
+        elif action == ACTION_ANNOUNCE:
+            if self.drop:
+                self.drop -= 1
+                return
+            self.announces.append(data)
+            self.transport.sendto(struct.pack(">IIIII", ACTION_ANNOUNCE, tid, 1800, 3, 7) + PEERS, addr)
+        elif action == ACTION_SCRAPE:
+            hashes = [data[i:i + 20] for i in range(16, len(data), 20)]
+            self.scrapes.append(hashes)
+            reply = struct.pack(">II", ACTION_SCRAPE, tid)
+            for n, _ in enumerate(hashes):
+                reply += struct.pack(">III", n, n * 2, n * 3)
+            self.transport.sendto(reply, addr)
+
+
+def run_with_tracker(test, **stub_args):
+    async def main():
+        loop = asyncio.get_running_loop()
+        stub = StubTracker(**stub_args)
+        transport, _ = await loop.create_datagram_endpoint(lambda: stub, local_addr=("127.0.0.1", 0))
+        port = transport.get_extra_info("sockname")[1]
+        client = UDPTrackerClient(base_timeout=0.2, max_retries=2)
+        try:
+            await test(client, stub, port)
+        finally:
+            client.close()
+            transport.close()
+    asyncio.run(main())
+
+
+def announce(client, port, info_hash=b"i" * 20, event=2):
+    return client.announce("127.0.0.1", port, info_hash, b"p" * 20, 0, 1000, 0, event, 1234, 6881)
+
+
+def test_announce_parses_response():
+    async def test(client, stub, port):
+        interval, leechers, seeders, peers = await announce(client, port)
+        assert (interval, leechers, seeders, peers) == (1800, 3, 7, PEERS)
+
+        packet = stub.announces[0]
+        assert packet[16:36] == b"i" * 20
+        event, _, key, num_want, listen_port = struct.unpack(">IIIiH", packet[80:98])
+        assert (event, key, num_want, listen_port) == (2, 1234, -1, 6881)
+    run_with_tracker(test)
+
+
+def test_concurrent_requests_share_one_connect():
+    async def test(client, stub, port):
+        await asyncio.gather(*(announce(client, port, bytes([n]) * 20) for n in range(5)))
+        await announce(client, port)  # Cached connection ID
+        assert stub.connects == 1
+        assert len(stub.announces) == 6
+    run_with_tracker(test)
+
+
+def test_lost_announce_is_resent():
+    async def test(client, stub, port):
+        interval, _, _, _ = await announce(client, port)
+        assert interval == 1800
+        assert client.retransmits == 1
+        assert len(stub.announces) == 1
+    run_with_tracker(test, drop=1)
+
+
+def test_silent_tracker_times_out():
+    async def test(client, stub, port):
+        with pytest.raises(UDPTrackerError):
+            await announce(client, port)
+        assert client.retransmits == 2
+    run_with_tracker(test, drop=10)
+
+
+def test_tracker_error_is_raised():
+    async def test(client, stub, port):
+        with pytest.raises(UDPTrackerError, match="torrent not registered"):
+            await announce(client, port)
+    run_with_tracker(test, error=b"torrent not registered")
+
+
+def test_scrape_batches_74_hashes_per_packet():
+    hashes = [n.to_bytes(20, "big") for n in range(MAX_SCRAPE_HASHES + 26)]
+
+    async def test(client, stub, port):
+        results = await client.scrape("127.0.0.1", port, hashes)
+        assert [len(batch) for batch in stub.scrapes] == [MAX_SCRAPE_HASHES, 26]
+        assert len(results) == len(hashes)
+        assert results[hashes[MAX_SCRAPE_HASHES + 1]] == (1, 2, 3)
+        assert stub.connects == 1
+    run_with_tracker(test)
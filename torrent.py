@@ -33,6 +33,14 @@ class Torrent:
         logger.info(f"Pieces: {self.number_of_pieces} (Length: {self.piece_length})")
         logger.info(f"Info Hash: {self.info_hash.hex()}")
 
+    def piece_size(self, index):
+        """Every piece is 'piece_length' long except (maybe) the last one."""
+        if index == self.number_of_pieces - 1:
+            remainder = self.total_length % self.piece_length
+            if remainder:
+                return remainder
+        return self.piece_length
+
     def _load_meta_info(self):
         with open(self.file_path, 'rb') as f:
             data = f.read()
@@ -1,151 +1,328 @@
+import asyncio
 import socket
 import struct
 import random
-import requests
+import time
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import urlparse
+from bencoding import Decoder
+from udp_tracker import UDPTrackerClient
 from utils import logger
 from ui import ui
 
+# Announce timing (seconds)
+TRACKER_DEADLINE = 10  # Hard deadline for one HTTP announce (DNS + connect + response)
+UDP_MAX_RETRIES = 2  # UDP gives up after 15 + 30 + 60 seconds (BEP 15 timing)
+DEFAULT_INTERVAL = 1800  # Used until the tracker tells us its own
+STOPPED_DEADLINE = 5  # 'stopped' is best effort: a stop never waits longer for it
+RETRY_BASE = 15  # First retry after a failure, doubled every time
+MAX_BACKOFF = 3600
+HTTP_WORKERS = 4  # Threads for blocking HTTP announces, shared by every torrent
+
+# UDP trackers send the event as a number (BEP 15)
+UDP_EVENTS = {'': 0, 'completed': 1, 'started': 2, 'stopped': 3}
+
+# Own threads for HTTP announces: a hung one (slow DNS, trickling response) keeps
+# running past its deadline, and must not take the default executor's threads
+# (disk reads, flushes, rechecks). Threads are only started when needed.
+_http_executor = ThreadPoolExecutor(max_workers=HTTP_WORKERS, thread_name_prefix="http-tracker")
+
+
+class TrackerError(Exception):
+    """The tracker answered, but with an error (or something we can't parse)."""
+
+
+class TrackerState:
+    """Announce bookkeeping for one tracker URL."""
+
+    def __init__(self, url):
+        self.url = url
+        self.interval = DEFAULT_INTERVAL
+        self.min_interval = None  # Only if the tracker sends one
+        self.next_announce = 0  # Due immediately
+        self.last_announce = 0
+        self.attempts = 0
+        self.failures = 0  # Consecutive
+        self.last_error = None
+        self.in_flight = False
+
+        # Swarm size as reported by the tracker (None = not reported)
+        self.seeders = None
+        self.leechers = None
+
+        self.started = False  # Tracker accepted our 'started' event
+        self.completed_sent = False
+
+    def succeeded(self, response, event):
+        now = time.time()
+        self.interval = response.get('interval') or self.interval
+        if response.get('min interval'):
+            self.min_interval = min(response['min interval'], self.interval)
+        self.last_announce = now
+        self.next_announce = now + self.interval
+        self.failures = 0
+        self.last_error = None
+        self.seeders = response.get('complete', self.seeders)
+        self.leechers = response.get('incomplete', self.leechers)
+        if event == 'started':
+            self.started = True
+        elif event == 'completed':
+            self.completed_sent = True
+        elif event == 'stopped':
+            # The torrent may be started again later (paused in a Session)
+            self.started = False
+            self.next_announce = 0
+
+    def failed(self, error):
+        # Exponential backoff with jitter so dead trackers cost (almost) nothing
+        self.failures += 1
+        delay = min(MAX_BACKOFF, RETRY_BASE * 2 ** (self.failures - 1))
+        self.next_announce = time.time() + delay * random.uniform(0.8, 1.2)
+        self.last_error = error
+
 
 class TrackerManager:
-    def __init__(self, torrent):
+    def __init__(self, torrent, stats=None, udp_client=None):
         self.torrent = torrent
         self.peer_id = torrent.peer_id  # We need to pass this in from Client
         self.peers = []  # List of (ip, port)
+        self._seen = set()
+
+        # Returns (uploaded, downloaded, left) in bytes, reported on every announce
+        self.stats = stats or (lambda: (0, 0, torrent.total_length))
+
+        # One UDP socket can serve every tracker (and every torrent)
+        self.udp_client = udp_client
+        self.key = random.getrandbits(32)  # Lets trackers recognise us across IP changes
+        self.listen_port = 6881  # Where peers can reach us (set by the client once listening)
 
-    def get_peers(self):
+        self.trackers = [TrackerState(url) for url in torrent.announce_list]
+        self.on_peers = None
+        self._completed_this_session = True
+        self._stopping = False
+        self.first_round_done = asyncio.Event()
+        self._wakeup = asyncio.Event()
+
+    async def run(self, on_peers=None):
         """
-        Queries all trackers in the list to find peers.
-        Tries UDP first (faster), then HTTP.
+        Announce scheduler. Runs for the whole download.
+        Every tracker (all tiers) is announced to at the same time, each under
+        its own deadline, then again every 'interval' seconds. Failed trackers
+        back off exponentially. 'on_peers' is called with new peers as soon as
+        any tracker answers.
         """
-        for url in self.torrent.announce_list:
+        self.on_peers = on_peers
+        self._stopping = False
+        # Seeding from the start: there is no download to report as 'completed'
+        self._completed_this_session = self.stats()[2] > 0
+        tasks = set()
+        if not self.trackers:
+            self.first_round_done.set()
+
+        while not self._stopping:
+            now = time.time()
+            for tracker in self.trackers:
+                if not tracker.in_flight and tracker.next_announce <= now:
+                    tracker.in_flight = True
+                    task = asyncio.create_task(self._announce(tracker, self._event_for(tracker)))
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+
+            idle = [t.next_announce for t in self.trackers if not t.in_flight]
+            wait = min(idle) - now if idle else DEFAULT_INTERVAL
+            self._wakeup.clear()
             try:
-                if url.startswith("udp"):
-                    peers = self._scrape_udp(url)
-                elif url.startswith("http"):
-                    peers = self._scrape_http(url)
-                else:
-                    continue
-
-                if peers:
-                    ui.print_log(f"Found {len(peers)} peers from {url}", "INFO")
-                    self.peers.extend(peers)
-            except Exception as e:
-                # Trackers often fail/timeout, this is normal
-                # ui.print_log(f"Tracker failed {url}: {e}", "WARNING")
+                await asyncio.wait_for(self._wakeup.wait(), timeout=max(wait, 0.1))
+            except asyncio.TimeoutError:
                 pass
 
-        # Remove duplicates
-        self.peers = list(set(self.peers))
-        ui.print_log(f"Total Unique Peers: {len(self.peers)}", "INFO")
-        return self.peers
-
-    def _scrape_http(self, url):
+    def need_more_peers(self):
         """
-        Connects to HTTP trackers.
-        Requires sending bytes as URL parameters.
+        The swarm is running out of candidates. Move every healthy tracker's
+        next announce forward, as far as its 'min interval' allows. Trackers
+        that don't send one are left at their regular 'interval'.
         """
-        params = {
-            'info_hash': self.torrent.info_hash,
-            'peer_id': self.peer_id,
-            'port': 6881,
-            'uploaded': 0,
-            'downloaded': 0,
-            'left': self.torrent.total_length,
-            'compact': 1,
-            'event': 'started'
-        }
-        try:
-            response = requests.get(url, params=params, timeout=5)
-            # Response is binary. Peers are at the end.
-            # (Simplification: Real parsing requires checking bencoded response structure)
-            # But most modern trackers return compact binary directly or in 'peers' key
-            return self._parse_compact_peers(response.content)
-        except:
-            return []
-
-    def _scrape_udp(self, url):
+        for tracker in self.trackers:
+            if tracker.failures or tracker.in_flight or not tracker.min_interval:
+                continue
+            earliest = tracker.last_announce + tracker.min_interval
+            if earliest < tracker.next_announce:
+                tracker.next_announce = earliest
+        self._wakeup.set()
+
+    async def announce_event(self, event):
         """
-        The Hard Part: Implementing BitTorrent UDP Protocol manually.
-        Structure:
-        1. Connect Request -> 2. Connection ID -> 3. Announce Request -> 4. Peer IPs
+        Sends 'completed' or 'stopped' right away to every tracker that knows us.
+        'stopped' gives up after STOPPED_DEADLINE seconds (a silent UDP tracker
+        would otherwise hold the shutdown for its whole retry schedule).
         """
-        parsed = urlparse(url)
-        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        sock.settimeout(4)
+        if event == 'stopped':
+            self._stopping = True  # No regular announces after this one
+        targets = [t for t in self.trackers if t.started]
+        if event == 'completed':
+            if not self._completed_this_session:
+                return
+            targets = [t for t in targets if not t.completed_sent]
+        announces = asyncio.gather(*(self._announce(t, event) for t in targets))
+        if event != 'stopped':
+            await announces
+            return
+        try:
+            await asyncio.wait_for(announces, STOPPED_DEADLINE)
+        except asyncio.TimeoutError:
+            logger.debug("Some trackers did not answer 'stopped' in time")
 
+    def _event_for(self, tracker):
+        if not tracker.started:
+            return 'started'
+        if self._completed_this_session and not tracker.completed_sent and self.stats()[2] == 0:
+            return 'completed'
+        return ''
+
+    async def _announce(self, tracker, event):
+        uploaded, downloaded, left = self.stats()
         try:
-            # 1. Connection Request
-            connection_id = 0x41727101980  # Magic constant
-            action = 0  # 0 = connect
-            transaction_id = random.getrandbits(32)
+            response = await self._announce_url(tracker.url, event, uploaded, downloaded, left)
+        except Exception as e:
+            # Trackers often fail/timeout, this is normal
+            tracker.failed(e)
+        else:
+            tracker.succeeded(response, event)
+            self._add_peers(tracker.url, response.get('peers', []))
+        finally:
+            tracker.attempts += 1
+            tracker.in_flight = False
+            if all(t.attempts for t in self.trackers) and not self.first_round_done.is_set():
+                ui.print_log(f"Total Unique Peers: {len(self.peers)}", "INFO")
+                self.first_round_done.set()
+            self._wakeup.set()
 
-            # Pack struct: (Sign: >QII) = Big-endian, Unsigned Long Long, Int, Int
-            packet = struct.pack('>QII', connection_id, action, transaction_id)
-            sock.sendto(packet, (parsed.hostname, parsed.port))
+    def _add_peers(self, url, peers):
+        new_peers = [p for p in peers if p not in self._seen]
+        self._seen.update(new_peers)
+        if new_peers:
+            ui.print_log(f"Found {len(peers)} peers from {url}", "INFO")
+            self.peers.extend(new_peers)
+            if self.on_peers:
+                self.on_peers(new_peers)
 
-            # 2. Receive Connection Response
-            response, _ = sock.recvfrom(2048)
-            if len(response) < 16:
-                return []
+    async def _announce_url(self, url, event, uploaded, downloaded, left):
+        if url.startswith("udp"):
+            return await self._announce_udp(url, event, uploaded, downloaded, left)
+        elif url.startswith("http"):
+            # requests is blocking, so HTTP announces run in the tracker threads.
+            # Past the deadline we stop waiting (one still queued is dropped).
+            loop = asyncio.get_running_loop()
+            return await asyncio.wait_for(
+                loop.run_in_executor(
+                    _http_executor, self._scrape_http, url, event, uploaded, downloaded, left
+                ),
+                TRACKER_DEADLINE
+            )
+        raise ValueError(f"Unsupported tracker: {url}")
 
-            # Unpack: action, transaction_id, connection_id
-            res_action, res_trans_id, conn_id = struct.unpack('>IIQ', response[:16])
+    async def _announce_udp(self, url, event, uploaded, downloaded, left):
+        """UDP trackers go through the shared asyncio UDP engine (udp_tracker.py)."""
+        if self.udp_client is None:
+            self.udp_client = UDPTrackerClient(max_retries=UDP_MAX_RETRIES)
 
-            if res_action != 0 or res_trans_id != transaction_id:
-                return []
+        parsed = urlparse(url)
+        interval, leechers, seeders, peer_data = await self.udp_client.announce(
+            parsed.hostname, parsed.port, self.torrent.info_hash, self.peer_id,
+            downloaded, left, uploaded, UDP_EVENTS[event], self.key, self.listen_port
+        )
+        return {
+            'peers': self._parse_compact_peers(peer_data),
+            'interval': interval,
+            'complete': seeders,
+            'incomplete': leechers,
+        }
 
-            # 3. Announce Request
-            action = 1  # 1 = announce
-            key = random.getrandbits(32)
+    def _scrape_http(self, url, event, uploaded, downloaded, left):
+        """
+        Connects to HTTP trackers.
+        Requires sending bytes as URL parameters.
+        """
+        params = {
+            'info_hash': self.torrent.info_hash,
+            'peer_id': self.peer_id,
+            'port': self.listen_port,
+            'uploaded': uploaded,
+            'downloaded': downloaded,
+            'left': left,
+            'compact': 1,
+        }
+        if event:
+            params['event'] = event
 
-            # Complex struct packing for announce
-            # info_hash(20), peer_id(20), downloaded(8), left(8), uploaded(8)
-            # event(4), ip(4), key(4), num_want(4), port(2)
-            packet = struct.pack('>QII', conn_id, action, transaction_id)
-            packet += self.torrent.info_hash
-            packet += self.peer_id
-            packet += struct.pack('>QQQIIIiH', 0, self.torrent.total_length, 0, 2, 0, key, -1, 6881)
+        import requests  # Here, not at the top: it adds ~100 ms to every startup
+        response = requests.get(url, params=params, timeout=5)
+        response.raise_for_status()
+        return self._parse_http_response(response.content)
 
-            sock.sendto(packet, (parsed.hostname, parsed.port))
+    def _parse_http_response(self, content):
+        """
+        HTTP trackers answer with a bencoded dict. 'peers' is either a compact
+        string (6 bytes per peer) or a list of {ip, port} dicts, and IPv6 peers
+        come separately in 'peers6' (18 bytes per peer).
+        """
+        try:
+            data = Decoder(content).decode()
+        except (ValueError, IndexError):
+            raise TrackerError("Malformed tracker response")
+        if not isinstance(data, dict):
+            raise TrackerError("Malformed tracker response")
 
-            # 4. Receive Peer List
-            response, _ = sock.recvfrom(4096)
+        if 'failure reason' in data:
+            raise TrackerError(data['failure reason'].decode('utf-8', 'replace'))
+        if 'warning message' in data:
+            logger.warning(f"Tracker warning: {data['warning message'].decode('utf-8', 'replace')}")
 
-            # Skip first 20 bytes (action, trans_id, intervals...)
-            # Peers start at byte 20. Each peer is 6 bytes (4 byte IP + 2 byte Port)
-            return self._parse_compact_peers(response[20:])
+        peers = data.get('peers', b'')
+        if isinstance(peers, bytes):
+            peers = self._parse_compact_peers(peers)
+        else:
+            peers = self._parse_dict_peers(peers)
+        peers += self._parse_compact_peers6(data.get('peers6', b''))
 
-        except Exception as e:
-            return []
-        finally:
-            sock.close()
+        response = {'peers': peers}
+        for key in ('interval', 'min interval', 'complete', 'incomplete'):
+            if isinstance(data.get(key), int):
+                response[key] = data[key]
+        return response
 
     def _parse_compact_peers(self, data):
         """
         Parses a binary string where every 6 bytes represents an IP:Port.
         """
         peers = []
-        # Sometimes http trackers return bencoded dicts, we need to handle raw bytes
-        # If data is bytes, try to extract just the peer list if it's mixed
-        try:
-            offset = 0
-            while offset < len(data):
-                # We need at least 6 bytes
-                if offset + 6 > len(data):
-                    break
-
-                ip_bytes = data[offset: offset + 4]
-                port_bytes = data[offset + 4: offset + 6]
-
-                # Convert bytes to string IP (e.g., 192.168.1.1)
-                ip = socket.inet_ntoa(ip_bytes)
-                # Convert bytes to int Port (Big Endian)
-                port = struct.unpack('>H', port_bytes)[0]
+        for offset in range(0, len(data) - 5, 6):
+            # Convert bytes to string IP (e.g., 192.168.1.1)
+            ip = socket.inet_ntoa(data[offset: offset + 4])
+            # Convert bytes to int Port (Big Endian)
+            port = struct.unpack('>H', data[offset + 4: offset + 6])[0]
+            if port:
+                peers.append((ip, port))
+        return peers
 
+    def _parse_compact_peers6(self, data):
+        """Same as above for IPv6: 16 bytes of address + 2 bytes of port."""
+        peers = []
+        for offset in range(0, len(data) - 17, 18):
+            ip = socket.inet_ntop(socket.AF_INET6, data[offset: offset + 16])
+            port = struct.unpack('>H', data[offset + 16: offset + 18])[0]
+            if port:
                 peers.append((ip, port))
-                offset += 6
-        except:
-            pass
+        return peers
 
+    def _parse_dict_peers(self, entries):
+        """Non-compact form: a list of dicts with 'ip' (string) and 'port'."""
+        peers = []
+        for entry in entries:
+            if not isinstance(entry, dict):
+                continue
+            ip = entry.get('ip')
+            port = entry.get('port')
+            if isinstance(ip, bytes) and isinstance(port, int) and 0 < port < 65536:
+                peers.append((ip.decode('utf-8', 'replace'), port))
         return peers
\ No newline at end of file
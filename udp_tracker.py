@@ -0,0 +1,206 @@
+import asyncio
+import random
+import socket
+import struct
+import time
+
+PROTOCOL_ID = 0x41727101980  # Magic constant (BEP 15)
+CONNECTION_ID_LIFETIME = 60  # seconds a connection ID stays valid
+
+# Actions
+ACTION_CONNECT = 0
+ACTION_ANNOUNCE = 1
+ACTION_SCRAPE = 2
+ACTION_ERROR = 3
+
+# A scrape packet carries at most 74 info-hashes (BEP 15)
+MAX_SCRAPE_HASHES = 74
+
+
+class UDPTrackerError(Exception):
+    """The UDP tracker sent an error, garbage, or nothing at all."""
+
+
+class _UDPTrackerProtocol(asyncio.DatagramProtocol):
+    def __init__(self, client):
+        self.client = client
+
+    def datagram_received(self, data, addr):
+        self.client._datagram_received(data)
+
+    def error_received(self, exc):
+        # ICMP port unreachable etc. The request will simply time out.
+        pass
+
+
+class UDPTrackerClient:
+    """
+    One UDP socket for every UDP tracker (and every torrent).
+    Requests are matched to responses by transaction ID, connection IDs
+    are cached for their 60 second lifetime, and lost packets are resent
+    after 15 * 2^n seconds as BEP 15 asks. 'max_retries' caps n.
+    """
+
+    def __init__(self, base_timeout=15, max_retries=8):
+        self.base_timeout = base_timeout
+        self.max_retries = max_retries
+        self.transport = None
+        self._endpoint_lock = asyncio.Lock()
+
+        self._transactions = {}  # transaction_id -> future
+        self._connections = {}  # (ip, port) -> (connection_id, expires_at)
+        self._connecting = {}  # (ip, port) -> task (shared by concurrent requests)
+
+        # Stats
+        self.packets_sent = 0
+        self.retransmits = 0
+
+    async def _ensure_endpoint(self):
+        async with self._endpoint_lock:
+            if self.transport is None:
+                loop = asyncio.get_running_loop()
+                self.transport, _ = await loop.create_datagram_endpoint(
+                    lambda: _UDPTrackerProtocol(self), local_addr=('0.0.0.0', 0)
+                )
+
+    def close(self):
+        if self.transport is not None:
+            self.transport.close()
+            self.transport = None
+        for future in self._transactions.values():
+            if not future.done():
+                future.cancel()
+        self._transactions.clear()
+
+    # --- Public API ---
+
+    async def announce(self, host, port, info_hash, peer_id, downloaded, left, uploaded,
+                       event, key, listen_port, num_want=-1):
+        """
+        Returns (interval, leechers, seeders, compact peer bytes).
+        'event' is the BEP 15 number (0 none, 1 completed, 2 started, 3 stopped).
+        """
+        addr = await self._resolve(host, port)
+
+        def build(connection_id, transaction_id):
+            # info_hash(20), peer_id(20), downloaded(8), left(8), uploaded(8)
+            # event(4), ip(4), key(4), num_want(4), port(2)
+            return (
+                struct.pack('>QII', connection_id, ACTION_ANNOUNCE, transaction_id)
+                + info_hash + peer_id
+                + struct.pack('>QQQIIIiH', downloaded, left, uploaded, event, 0, key,
+                              num_want, listen_port)
+            )
+
+        response = await self._request(addr, build, ACTION_ANNOUNCE)
+        if len(response) < 20:
+            raise UDPTrackerError("Short UDP announce response")
+        interval, leechers, seeders = struct.unpack('>III', response[8:20])
+        return interval, leechers, seeders, response[20:]
+
+    async def scrape(self, host, port, info_hashes):
+        """
+        Scrapes many torrents at once, 74 per packet.
+        Returns {info_hash: (seeders, completed, leechers)}.
+        """
+        addr = await self._resolve(host, port)
+        results = {}
+
+        for start in range(0, len(info_hashes), MAX_SCRAPE_HASHES):
+            batch = info_hashes[start: start + MAX_SCRAPE_HASHES]
+
+            def build(connection_id, transaction_id, batch=batch):
+                return struct.pack('>QII', connection_id, ACTION_SCRAPE, transaction_id) + b"".join(batch)
+
+            response = await self._request(addr, build, ACTION_SCRAPE)
+            for i, info_hash in enumerate(batch):
+                offset = 8 + i * 12
+                if offset + 12 > len(response):
+                    break
+                results[info_hash] = struct.unpack('>III', response[offset: offset + 12])
+
+        return results
+
+    # --- Internals ---
+
+    async def _resolve(self, host, port):
+        await self._ensure_endpoint()
+        loop = asyncio.get_running_loop()
+        infos = await loop.getaddrinfo(host, port, family=socket.AF_INET, type=socket.SOCK_DGRAM)
+        if not infos:
+            raise UDPTrackerError(f"Cannot resolve {host}")
+        return infos[0][4][:2]
+
+    async def _request(self, addr, build, action):
+        """Connection ID + request, resending with BEP 15 backoff until it answers."""
+        for n in range(self.max_retries + 1):
+            timeout = self.base_timeout * 2 ** n
+            if n:
+                self.retransmits += 1
+            try:
+                connection_id = await self._connection_id(addr, timeout)
+                response = await self._transact(addr, lambda tid: build(connection_id, tid), timeout)
+            except asyncio.TimeoutError:
+                # The connection ID may have expired on the tracker's side
+                self._connections.pop(addr, None)
+                continue
+
+            if struct.unpack('>I', response[:4])[0] != action:
+                raise UDPTrackerError("Unexpected UDP tracker action")
+            return response
+
+        raise UDPTrackerError("UDP tracker timed out")
+
+    async def _connection_id(self, addr, timeout):
+        cached = self._connections.get(addr)
+        if cached and cached[1] > time.monotonic():
+            return cached[0]
+
+        # Several announces to the same tracker share one connect round trip
+        task = self._connecting.get(addr)
+        if task is None:
+            task = asyncio.ensure_future(self._connect(addr, timeout))
+            self._connecting[addr] = task
+            task.add_done_callback(lambda _: self._connecting.pop(addr, None))
+        return await asyncio.shield(task)
+
+    async def _connect(self, addr, timeout):
+        response = await self._transact(
+            addr, lambda tid: struct.pack('>QII', PROTOCOL_ID, ACTION_CONNECT, tid), timeout
+        )
+        if len(response) < 16:
+            raise UDPTrackerError("Short UDP connect response")
+        action, _, connection_id = struct.unpack('>IIQ', response[:16])
+        if action != ACTION_CONNECT:
+            raise UDPTrackerError("Bad UDP connect response")
+
+        self._connections[addr] = (connection_id, time.monotonic() + CONNECTION_ID_LIFETIME)
+        return connection_id
+
+    async def _transact(self, addr, build, timeout):
+        """Sends one packet and waits for the response with the same transaction ID."""
+        transaction_id = random.getrandbits(32)
+        while transaction_id in self._transactions:
+            transaction_id = random.getrandbits(32)
+
+        future = asyncio.get_running_loop().create_future()
+        self._transactions[transaction_id] = future
+        try:
+            self.transport.sendto(build(transaction_id), addr)
+            self.packets_sent += 1
+            return await asyncio.wait_for(future, timeout)
+        finally:
+            self._transactions.pop(transaction_id, None)
+
+    def _datagram_received(self, data):
+        if len(data) < 8:
+            return
+        action, transaction_id = struct.unpack('>II', data[:8])
+        future = self._transactions.get(transaction_id)
+        if future is None or future.done():
+            return  # Late answer to a request we already resent or gave up on
+
+        if action == ACTION_ERROR:
+            future.set_exception(UDPTrackerError(data[8:].decode('utf-8', 'replace')))
+        else:
+            future.set_result(data)
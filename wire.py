@@ -0,0 +1,184 @@
+import asyncio
+from utils import logger
+
+RECV_BUFFER_SIZE = 256 * 1024  # Grows if a single message is bigger
+MIN_READ = 16 * 1024  # Less free space than this at the end: move the leftover to the front
+MAX_MESSAGE_LENGTH = 2 ** 21  # Way past any legit message (128KB blocks, bitfields of 16M pieces)
+HANDSHAKE_LENGTH = 68
+HANDSHAKE_TIMEOUT = 10  # seconds
+
+
+class WireProtocol(asyncio.BufferedProtocol):
+    """
+    BitTorrent framing straight on the transport.
+    The socket reads into one reusable buffer and every complete message in
+    it is handed to the handler in the same call, as a memoryview into that
+    buffer (no copy, no coroutine switch per message). The view is only
+    valid during the call: whatever the handler keeps, it has to copy.
+
+    The handler gets:
+        connection_made(wire)
+        handshake_received(wire, data)  - the first 68 bytes (a copy)
+        message_received(msg_id, payload)  - msg_id None = keep-alive
+        connection_lost(exc)
+    message_received may return an awaitable (rate limit, hash queue full).
+    Parsing and socket reads stop until it is done, so TCP slows the
+    sender down and the payload view stays valid while it runs.
+    """
+
+    def __init__(self, handler):
+        self.handler = handler
+        self.transport = None
+        self.lost = asyncio.get_running_loop().create_future()
+
+        self._buf = bytearray(RECV_BUFFER_SIZE)
+        self._start = 0  # First byte not parsed yet
+        self._end = 0  # End of the received data
+        self._handshaken = False
+        self._handshake_timer = None
+        self._busy = False  # Waiting for an awaitable from the handler
+
+        self._write_paused = False
+        self._drain_waiter = None
+
+    # --- asyncio callbacks ---
+
+    def connection_made(self, transport):
+        self.transport = transport
+        loop = asyncio.get_running_loop()
+        self._handshake_timer = loop.call_later(HANDSHAKE_TIMEOUT, self._handshake_timeout)
+        self.handler.connection_made(self)
+
+    def connection_lost(self, exc):
+        if self._handshake_timer:
+            self._handshake_timer.cancel()
+        if not self.lost.done():
+            self.lost.set_result(exc)
+        self._wake_drain()
+        self.handler.connection_lost(exc)
+
+    def get_buffer(self, sizehint):
+        if self._start == self._end:
+            self._start = self._end = 0
+        elif len(self._buf) - self._end < MIN_READ:
+            self._compact()
+        return memoryview(self._buf)[self._end:]
+
+    def buffer_updated(self, nbytes):
+        self._end += nbytes
+        self._process()
+
+    def eof_received(self):
+        return False  # Close
+
+    def pause_writing(self):
+        self._write_paused = True
+
+    def resume_writing(self):
+        self._write_paused = False
+        self._wake_drain()
+
+    # --- Writing ---
+
+    def write(self, data):
+        self.transport.write(data)
+
+    async def drain(self):
+        """Waits until the transport's write buffer is below its high-water mark."""
+        if self.lost.done():
+            raise ConnectionError("Connection lost")
+        if not self._write_paused:
+            return
+        self._drain_waiter = asyncio.get_running_loop().create_future()
+        await self._drain_waiter
+
+    def close(self):
+        if self.transport:
+            self.transport.close()
+
+    # --- Parsing ---
+
+    def _process(self):
+        while not self._busy and not self.transport.is_closing():
+            available = self._end - self._start
+
+            if not self._handshaken:
+                if available < HANDSHAKE_LENGTH:
+                    return
+                self._handshaken = True
+                self._handshake_timer.cancel()
+                handshake = bytes(self._buf[self._start:self._start + HANDSHAKE_LENGTH])
+                self._start += HANDSHAKE_LENGTH
+                self._call(self.handler.handshake_received, self, handshake)
+                continue
+
+            if available < 4:
+                return
+            start = self._start
+            length = int.from_bytes(self._buf[start:start + 4], "big")
+            if length > MAX_MESSAGE_LENGTH:
+                logger.debug(f"Message of {length} bytes, closing")
+                self.transport.close()
+                return
+            if available < 4 + length:
+                self._reserve(4 + length)
+                return
+
+            self._start = start + 4 + length
+            if length == 0:
+                self._call(self.handler.message_received, None, b"")
+            else:
+                payload = memoryview(self._buf)[start + 5:start + 4 + length]
+                self._call(self.handler.message_received, self._buf[start + 4], payload)
+
+    def _call(self, callback, *args):
+        try:
+            pending = callback(*args)
+        except Exception:
+            logger.debug("Bad message, closing", exc_info=True)
+            self.transport.close()
+            return
+        if pending is not None:
+            self._busy = True
+            self.transport.pause_reading()
+            asyncio.ensure_future(pending).add_done_callback(self._handler_done)
+
+    def _handler_done(self, task):
+        self._busy = False
+        if self.transport.is_closing():
+            return
+        if task.cancelled() or task.exception() is not None:
+            if not task.cancelled():
+                logger.debug("Bad message, closing", exc_info=task.exception())
+            self.transport.close()
+            return
+        self.transport.resume_reading()
+        self._process()
+
+    def _compact(self):
+        # Only the start of an incomplete message is left: move it to the front
+        leftover = self._end - self._start
+        self._buf[:leftover] = self._buf[self._start:self._end]
+        self._start, self._end = 0, leftover
+
+    def _reserve(self, size):
+        """Makes sure a message of 'size' bytes fits from _start on."""
+        if self._start + size <= len(self._buf):
+            return
+        if size <= len(self._buf):
+            self._compact()
+            return
+        # A new buffer rather than a resize: old views may still be around
+        leftover = self._end - self._start
+        buf = bytearray(max(size, 2 * len(self._buf)))
+        buf[:leftover] = self._buf[self._start:self._end]
+        self._buf, self._start, self._end = buf, 0, leftover
+
+    def _handshake_timeout(self):
+        if not self._handshaken:
+            self.transport.close()
+
+    def _wake_drain(self):
+        waiter, self._drain_waiter = self._drain_waiter, None
+        if waiter and not waiter.done():
+            waiter.set_result(None)